@@ -2,17 +2,33 @@ from fastapi import APIRouter, Depends, HTTPException
 from db.models import get_db
 from utils.auth import get_current_user
 from sqlalchemy.orm import Session
-from db.models import User, Organization, Prompt, Contact
-from openai import OpenAI
-from dotenv import load_dotenv
-from typing import Optional, Dict, Any, List
+from db.models import User, Organization, Prompt, Contact, LeadQualification
+from typing import Optional, Dict, Any, List, Tuple
 import json
+import os
+import asyncio
+import re
 from pydantic import BaseModel
 from schemas.contacts_schema import PrompCreatetModel
-from wp.send_msg_imgs import send_txt_msg
+from wp.outbox import outbox
+from wp.dedupe import message_dedupe
 
-from utils.auth import get_organization_products
-import asyncio
+from utils.auth import get_cached_organization_products
+from ai.engine import client, stream_assistant_run, thread_lock
+from ai.completions import build_chat_messages, stream_chat_completion
+from ai.summarizer import schedule_compaction
+from schemas.organizations_schema import build_assistant_instructions
+from ai.classifier import (
+    DEFAULT_LOW_THRESHOLD, DEFAULT_HIGH_THRESHOLD,
+    classify_locally, get_thresholds, record_tier, tier_stats
+)
+from utils.cache import TTLCache
+from utils.timing import StageTimer
+from utils.metrics import metrics
+from ai.governor import openai_call
+from utils.log import get_logger
+
+logger = get_logger(__name__)
 
 router= APIRouter(
     prefix="/api/prompt"
@@ -26,16 +42,60 @@ class LeadQualificationModel(BaseModel):
     timeline_confirmed: bool = False
     meeting_readiness: bool = False
     detected_type: str = None  # "B2B", "B2C", or None
-    
 
-load_dotenv()
-client= OpenAI()
 
-# Store the assistant ID for future use
+# BANT analysis results keyed on (org_id, normalized message text)
+qualification_cache = TTLCache(
+    maxsize=int(os.getenv("BANT_CACHE_SIZE", 5000)),
+    ttl=float(os.getenv("BANT_CACHE_TTL", 3600))
+)
+
+
+# BANT criteria and what the classifier looks for in each
+BANT_CRITERIA = ("budget", "authority", "need", "timeline")
+BANT_DESCRIPTIONS = {
+    "budget": "Message indicates budget discussion or financial capacity",
+    "authority": "Message indicates decision-making authority or involvement",
+    "need": "Message indicates clear business need or pain points",
+    "timeline": "Message indicates implementation timeline or urgency"
+}
+
+
+metrics.register_collector("qualification_cache", qualification_cache.stats)
+metrics.register_collector("classifier_tiers", tier_stats)
+
+
+# Function tools exposed to the organization assistant on every run
+ASSISTANT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_organization_products",
+            "description": "Get products for the current organization",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_meeting_link",
+            "description": "Get the organization's meeting link",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    }
+]
 
 def get_meeting_link(org_meeting_url: str = None):
     """Get meeting link for the organization"""
-    print('fn-01    ')
+    logger.debug("get_meeting_link called")
     if not org_meeting_url:
         return {"error": "No meeting URL configured"}
     return {"meeting_url": org_meeting_url}
@@ -52,45 +112,168 @@ def safe_execute_tool(func_name: str, arguments: Dict[str, Any], org_id: int = N
             # Use the org_id passed from the route
             if not org_id:
                 return {"error": "org_id is required"}
-            # Get DB session
-            db = next(get_db())
-            result = get_organization_products(org_id=org_id, db=db)
-            # Convert SQLAlchemy objects to dictionaries for JSON serialization
-            if isinstance(result, list):
-                result = [
-                    {
-                        "products": [{"id": p.id, "title": p.title, "description": p.description, 
-                                    "price": p.price_per_quantity, "currency": p.currency} 
-                                   for p in result[0]],
-                        "external_data": result[1] if len(result) > 1 else None
-                    }
-                ]
+            result = get_cached_organization_products(org_id)
         return result
     except Exception as e:
         return {"error": str(e)}
     
 
-def handle_tool_calls(tool_calls):
-    """Handle tool calls from the assistant with error handling"""
-    tool_outputs = []
-    
-    for tool_call in tool_calls:
-        try:
-            function_name = tool_call.function.name
-            arguments = json.loads(tool_call.function.arguments)
-            result = safe_execute_tool(function_name, arguments)
-            
-            tool_outputs.append({
-                "tool_call_id": tool_call.id,
-                "output": json.dumps(result)
-            })
-        except Exception as e:
-            tool_outputs.append({
-                "tool_call_id": tool_call.id,
-                "output": json.dumps({"error": "Internal processing error"})
-            })
-    
-    return tool_outputs
+@router.get('/qualification-cache')
+async def qualification_cache_stats(current_user: User = Depends(get_current_user)):
+    return qualification_cache.stats()
+
+@router.get('/classifier-stats')
+async def classifier_stats(current_user: User = Depends(get_current_user)):
+    return tier_stats()
+
+MEETING_READY_NOTE = "Note: Lead is qualified for meeting. You can share meeting link if appropriate."
+
+
+class AssistantRunError(Exception):
+    """The assistant run ended (failed, cancelled or expired) without a reply"""
+
+
+async def run_chat_pipeline(
+    db: Session,
+    prospect: Contact,
+    organization: Organization,
+    input_text: str,
+    posts: Optional[Dict[str, str]] = None
+) -> str:
+    """
+    Qualify, post and run one inbound message for a contact, then send and store the reply.
+    Raises on any failure so callers can decide whether to retry or apologise.
+
+    `posts` maps the WhatsApp message ids behind `input_text` to their text.
+    Ids posted to the thread and the reply to them are recorded, so a retry
+    only posts the rest and, once answered, just stores and queues the reply.
+    """
+    timer = StageTimer()
+    logger.info("Processing message", extra={"contact_id": prospect.id, "org_id": organization.id})
+    org_id= organization.id
+    assistant_id= organization.assistant_id
+    meeting_url= organization.meeting_url
+
+    # Load the contact's accumulated qualification state
+    qualification = get_qualification_state(db, prospect)
+    analyzed = not qualification.meeting_readiness
+
+    execute_tool = lambda function_name, arguments: safe_execute_tool(
+        function_name,
+        arguments,
+        org_id=org_id,
+        org_meeting_url=meeting_url
+    )
+
+    # A retry after the model already answered reuses that reply instead of starting another run
+    recorded_reply = message_dedupe.recorded_reply(db, posts) if posts else None
+    if recorded_reply is not None:
+        logger.info("Reusing the recorded reply of an earlier attempt", extra={"contact_id": prospect.id, "org_id": org_id})
+        assistant_response = recorded_reply
+    elif organization.conversation_engine == "completions":
+        # Local history + one streamed chat completion; replies to a contact stay serialized
+        async with thread_lock(f"contact:{prospect.id}"):
+            with timer.stage("qualification"):
+                meeting_ready = await evaluate_meeting_readiness(
+                    qualification,
+                    input_text,
+                    org_id=org_id,
+                    thresholds=get_thresholds(organization)
+                )
+            if analyzed:
+                db.commit()
+
+            with timer.stage("history"):
+                instructions = build_assistant_instructions(organization.business_model) + get_context_template(prospect)
+                if meeting_ready:
+                    instructions += "\n" + MEETING_READY_NOTE
+                messages = build_chat_messages(db, prospect, instructions, input_text)
+
+            with timer.stage("run"):
+                assistant_response = await stream_chat_completion(messages, ASSISTANT_TOOLS, execute_tool, org_id=org_id)
+    else:
+        # Only one run may be active per thread, and no message can be posted while it is
+        async with thread_lock(prospect.thread_id):
+            with timer.stage("history_check"):
+                has_no_prompts = db.query(Prompt.id).filter(Prompt.contact_id == prospect.id).first() is None
+                post_text, unposted_ids = input_text, []
+                if posts:
+                    already_posted = message_dedupe.posted_ids(db, posts)
+                    unposted_ids = [message_id for message_id in posts if message_id not in already_posted]
+                    post_text = "\n".join(posts[message_id] for message_id in unposted_ids)
+                    has_no_prompts = has_no_prompts and not already_posted
+
+            # BANT analysis and the thread message posts are independent, run them together
+            qualify = asyncio.ensure_future(timer.timed("qualification", evaluate_meeting_readiness(
+                qualification,
+                input_text,
+                org_id=org_id,
+                thresholds=get_thresholds(organization)
+            )))
+            post = asyncio.ensure_future(
+                timer.timed("post_messages", post_thread_messages(prospect, post_text, has_no_prompts)) if post_text
+                else asyncio.sleep(0)
+            )
+            try:
+                meeting_ready, _ = await asyncio.gather(qualify, post)
+            except BaseException:
+                # Nothing may keep posting to the thread once the lock is released
+                qualify.cancel()
+                post.cancel()
+                await asyncio.gather(qualify, post, return_exceptions=True)
+                raise
+            finally:
+                if unposted_ids and post.done() and not post.cancelled() and post.exception() is None:
+                    message_dedupe.mark_posted(db, unposted_ids)
+                    db.commit()
+            if analyzed:
+                db.commit()
+
+            with timer.stage("run"):
+                assistant_response = await stream_assistant_run(
+                    thread_id=prospect.thread_id,
+                    assistant_id=assistant_id,
+                    tools=ASSISTANT_TOOLS,
+                    execute_tool=execute_tool,
+                    # The readiness note only has to reach the run, not the stored thread message
+                    additional_instructions=MEETING_READY_NOTE if meeting_ready else None,
+                    org_id=org_id
+                )
+    if assistant_response is None:
+        raise AssistantRunError(f"Reply for contact {prospect.id} ended without a response")
+    if posts and recorded_reply is None:
+        message_dedupe.record_reply(db, posts, assistant_response)
+        db.commit()
+
+    # Store both the prompt and response in database, queueing the reply in the same transaction
+    with timer.stage("persist"):
+        new_prompt = Prompt(
+            organization_id=org_id,
+            contact_id=prospect.id,
+            input_text=input_text,
+            response_text=assistant_response
+        )
+        db.add(new_prompt)
+        db.flush()
+        if analyzed:
+            qualification.last_prompt_id = new_prompt.id
+        outbox.enqueue_text(db, org_id, prospect.phone_number, assistant_response, contact_id=prospect.id, prompt_id=new_prompt.id)
+        db.commit()
+    outbox.wake()
+
+    # Compaction runs later on the job workers, never on the reply path
+    try:
+        schedule_compaction(db, prospect)
+    except Exception as e:
+        db.rollback()
+        logger.warning("Could not schedule compaction", extra={"contact_id": prospect.id, "error": str(e)})
+
+    timings = timer.summary()
+    for stage, duration in timings.items():
+        metrics.observe("chat_stage_ms", duration, org_id, stage)
+    logger.info("Chat pipeline timings", extra={"contact_id": prospect.id, "org_id": org_id, "timings_ms": timings})
+    return assistant_response
+
 
 @router.post('/{org_id}/create/{contact_id}')
 async def chat_with_assistant(user_input: PrompCreatetModel, contact_id: int, org_id: int, db: Session = Depends(get_db)):
@@ -103,171 +286,53 @@ async def chat_with_assistant(user_input: PrompCreatetModel, contact_id: int, or
         if not organization:
             raise HTTPException(status_code=404, detail="Organization not found")
         
-        # Create qualification model instance
-        qualification = LeadQualificationModel()
-        
-        # Evaluate meeting readiness before processing message
-        meeting_ready = evaluate_meeting_readiness(qualification, user_input.input_text)
-        if meeting_ready:
-            user_input.input_text += "\n\nNote: Lead is qualified for meeting. You can share meeting link if appropriate."
-
-        print(f"Processing message from {prospect.name}")
-        assistant_id= organization.assistant_id
-
-        has_no_prompts = db.query(Prompt).filter(Prompt.contact_id == prospect.id).count() == 0
-        print(has_no_prompts)
-        if has_no_prompts:
-            print('efewewfewf')
-            context = get_context_template(prospect)
-            
-            message = client.beta.threads.messages.create(
-                thread_id=prospect.thread_id,
-                role="assistant",
-                content=context,
-            )
-        
-        # Add the user message
-        message = client.beta.threads.messages.create(
-            thread_id=prospect.thread_id,
-            role="user",
-            content=user_input.input_text,
-        )
-
         # Run the assistant with error handling
         try:
-            run = client.beta.threads.runs.create(
-                thread_id=prospect.thread_id,
-                assistant_id=assistant_id,
-                tools=[
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "get_organization_products",
-                            "description": "Get products for the current organization",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {},
-                                "required": []
-                            }
-                        }
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "get_meeting_link",
-                            "description": "Get the organization's meeting link",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {},
-                                "required": []
-                            }
-                        }
-                    }
-                ]
-            )
-
-            while True:
-                run = client.beta.threads.runs.retrieve(
-                    thread_id=prospect.thread_id,
-                    run_id=run.id
-                )
+            return await run_chat_pipeline(db, prospect, organization, user_input.input_text)
 
-                if run.status == "requires_action":
-                    tool_outputs = []
-                    for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                        function_name = tool_call.function.name
-                        # Pass both org_id and meeting_url
-                        result = safe_execute_tool(
-                            function_name, 
-                            {}, 
-                            org_id=org_id,
-                            org_meeting_url=organization.meeting_url
-                        )
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps(result)
-                        })
-                    
-                    run = client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=prospect.thread_id,
-                        run_id=run.id,
-                        tool_outputs=tool_outputs
-                    )
-
-                elif run.status == "completed":
-                    # Get the assistant's response
-                    messages = client.beta.threads.messages.list(
-                        thread_id=prospect.thread_id,
-                        order="desc",
-                        limit=1
-                    )
-                    assistant_response = messages.data[0].content[0].text.value
-                    send_txt_msg(prospect.phone_number ,assistant_response)
-                    # Store both the prompt and response in database
-                    new_prompt = Prompt(
-                        organization_id=organization.id,
-                        contact_id=prospect.id,
-                        input_text=user_input.input_text,
-                        response_text=assistant_response
-                    )
-                    db.add(new_prompt)
-                    db.commit()
-
-                    return assistant_response
-                
-                elif run.status in ["failed", "cancelled", "expired"]:
-                    print(f"Run failed with status: {run.status}")
-                    return "I apologize, but I'm having trouble processing your request. Could you please rephrase that?"
-                    
-                # Wait before polling again with exponential backoff
-                await asyncio.sleep(1)
+        except AssistantRunError as e:
+            logger.warning(str(e), extra={"contact_id": contact_id, "org_id": org_id})
+            return "I apologize, but I'm having trouble processing your request. Could you please rephrase that?"
 
         except Exception as e:
-            print(f"Error in chat_with_assistant: {str(e)}")
+            db.rollback()
+            logger.error("Error in chat_with_assistant", extra={"contact_id": contact_id, "org_id": org_id, "error": str(e)})
             return "I apologize, but I'm experiencing technical difficulties. Please try again in a moment."
         
     except Exception as e:
         db.rollback()
-        print(f"Database error: {str(e)}")
+        logger.error("Database error", extra={"contact_id": contact_id, "org_id": org_id, "error": str(e)})
         raise HTTPException(status_code=500, detail="Internal server error")
 
-def analyze_qualification_criteria(message_content: str) -> Dict[str, Any]:
+async def analyze_qualification_criteria(message_content: str, criteria=BANT_CRITERIA, detect_type: bool = False, org_id: int = None) -> Dict[str, Any]:
     """Analyzes message content to detect BANT criteria and other qualification signals"""
     
+    properties = {
+        f"{criterion}_confirmed": {
+            "type": "boolean",
+            "description": BANT_DESCRIPTIONS[criterion]
+        }
+        for criterion in criteria
+    }
+    properties["reasoning"] = {
+        "type": "object",
+        "properties": {criterion: {"type": "string"} for criterion in criteria},
+        "description": "Reasoning for each criterion detection"
+    }
+    if detect_type:
+        properties["detected_type"] = {
+            "type": "string",
+            "enum": ["B2B", "B2C", "unknown"],
+            "description": "Whether the sender is buying for a business (B2B) or for personal use (B2C)"
+        }
+
     function_json = {
         "name": "analyze_qualification",
         "description": "Analyze message content for sales qualification criteria",
         "parameters": {
             "type": "object",
-            "properties": {
-                "budget_confirmed": {
-                    "type": "boolean",
-                    "description": "Message indicates budget discussion or financial capacity"
-                },
-                "authority_confirmed": {
-                    "type": "boolean",
-                    "description": "Message indicates decision-making authority or involvement"
-                },
-                "need_confirmed": {
-                    "type": "boolean",
-                    "description": "Message indicates clear business need or pain points"
-                },
-                "timeline_confirmed": {
-                    "type": "boolean",
-                    "description": "Message indicates implementation timeline or urgency"
-                },
-                "reasoning": {
-                    "type": "object",
-                    "properties": {
-                        "budget": {"type": "string"},
-                        "authority": {"type": "string"},
-                        "need": {"type": "string"},
-                        "timeline": {"type": "string"}
-                    },
-                    "description": "Reasoning for each criterion detection"
-                }
-            },
-            "required": ["budget_confirmed", "authority_confirmed", "need_confirmed", "timeline_confirmed", "reasoning"]
+            "properties": properties,
+            "required": list(properties)
         }
     }
 
@@ -276,46 +341,116 @@ def analyze_qualification_criteria(message_content: str) -> Dict[str, Any]:
         {"role": "user", "content": message_content}
     ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        functions=[function_json],
-        function_call={"name": "analyze_qualification"}
-    )
+    # Function schema and system prompt add a few hundred tokens to the message itself
+    async with openai_call("bant_classifier", org_id, estimated_tokens=len(message_content) // 4 + 400) as tracked:
+        response = await client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            functions=[function_json],
+            function_call={"name": "analyze_qualification"}
+        )
+        tracked.usage(response.usage)
 
     result = json.loads(response.choices[0].message.function_call.arguments)
     return result
 
-def evaluate_meeting_readiness(user: LeadQualificationModel, message_content: str) -> bool:
-    qualification = user
-    
-    # Use AI to analyze the message content
-    analysis = analyze_qualification_criteria(message_content)
-    
-    # Update qualification based on AI analysis
-    qualification.budget_confirmed = qualification.budget_confirmed or analysis['budget_confirmed']
-    qualification.authority_confirmed = qualification.authority_confirmed or analysis['authority_confirmed']
-    qualification.need_confirmed = qualification.need_confirmed or analysis['need_confirmed']
-    qualification.timeline_confirmed = qualification.timeline_confirmed or analysis['timeline_confirmed']
-    
+def normalize_message(message_content: str) -> str:
+    """Normalize message text so trivial variations share a cache entry"""
+    text = re.sub(r"[^\w\s]", " ", message_content.lower())
+    return " ".join(text.split())
+
+
+def score_qualification(confirmed: Dict[str, bool]) -> Tuple[int, bool]:
+    """Return (qualification_score, meeting_readiness) for the confirmed BANT criteria"""
     # Calculate qualification score
-    score = sum([
-        qualification.budget_confirmed,
-        qualification.authority_confirmed,
-        qualification.need_confirmed,
-        qualification.timeline_confirmed
-    ]) * 25  # Each criterion is worth 25 points
-    
-    qualification.qualification_score = score
-    
+    score = sum(bool(confirmed.get(criterion)) for criterion in BANT_CRITERIA) * 25  # Each criterion is worth 25 points
+
     # Determine meeting readiness - require need confirmation and at least 2 other criteria
-    qualification.meeting_readiness = (
+    meeting_readiness = (
         score >= 75 and  # At least 3 criteria met
-        qualification.need_confirmed  # Must have confirmed need
+        bool(confirmed.get("need"))  # Must have confirmed need
     )
+    return score, meeting_readiness
+
+
+def get_qualification_state(db: Session, contact: Contact) -> LeadQualification:
+    """Return the contact's stored qualification state, creating it on first contact"""
+    qualification = contact.qualification
+    if qualification is None:
+        qualification = LeadQualification(
+            contact_id=contact.id,
+            budget_confirmed=False,
+            authority_confirmed=False,
+            need_confirmed=False,
+            timeline_confirmed=False,
+            qualification_score=0,
+            meeting_readiness=False
+        )
+        db.add(qualification)
+    return qualification
+
+
+async def evaluate_meeting_readiness(
+    qualification: LeadQualification,
+    message_content: str,
+    org_id: int = None,
+    thresholds: Tuple[float, float] = None
+) -> bool:
+    # Qualified leads keep their status, no need to classify further messages
+    if qualification.meeting_readiness:
+        return True
+
+    # Only ask about the criteria this contact has not confirmed yet
+    pending = tuple(c for c in BANT_CRITERIA if not getattr(qualification, f"{c}_confirmed"))
+    detect_type = qualification.detected_type is None
+
+    # Tier 1: settle the clear-cut criteria with the local scorer
+    low, high = thresholds or (DEFAULT_LOW_THRESHOLD, DEFAULT_HIGH_THRESHOLD)
+    analysis, ambiguous = classify_locally(message_content, pending, low, high)
+
+    if not ambiguous:
+        record_tier(org_id, "local")
+    else:
+        # Tier 2: ask the LLM about the ambiguous criteria, reusing earlier results for the same text
+        cache_key = (org_id, ambiguous, detect_type, normalize_message(message_content))
+        llm_analysis = qualification_cache.get(cache_key)
+        if llm_analysis is None:
+            record_tier(org_id, "llm")
+            llm_analysis = await analyze_qualification_criteria(message_content, criteria=ambiguous, detect_type=detect_type, org_id=org_id)
+            qualification_cache.set(cache_key, llm_analysis)
+        else:
+            record_tier(org_id, "cache")
+        analysis.update(llm_analysis)
+    
+    # Update qualification based on AI analysis
+    for criterion in pending:
+        if analysis.get(f"{criterion}_confirmed"):
+            setattr(qualification, f"{criterion}_confirmed", True)
+    if analysis.get("detected_type") in ("B2B", "B2C"):
+        qualification.detected_type = analysis["detected_type"]
     
+    qualification.qualification_score, qualification.meeting_readiness = score_qualification(
+        {criterion: getattr(qualification, f"{criterion}_confirmed") for criterion in BANT_CRITERIA}
+    )
     return qualification.meeting_readiness
 
+async def post_thread_messages(contact: Contact, input_text: str, include_context: bool):
+    """Post the first-contact context (if needed) and the user message to the contact's thread"""
+    if include_context:
+        async with openai_call("threads.messages.create", contact.org_id):
+            await client.beta.threads.messages.create(
+                thread_id=contact.thread_id,
+                role="assistant",
+                content=get_context_template(contact),
+            )
+
+    async with openai_call("threads.messages.create", contact.org_id):
+        await client.beta.threads.messages.create(
+            thread_id=contact.thread_id,
+            role="user",
+            content=input_text,
+        )
+
 def get_context_template(contact: Contact) -> str:
     """Generate context template based on business model and contact information"""
     base_context = f"""
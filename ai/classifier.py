@@ -0,0 +1,134 @@
+from collections import Counter
+from typing import Dict, Iterable, Optional, Tuple
+import math
+import os
+import re
+
+# Default confidence thresholds; organizations can override both
+DEFAULT_LOW_THRESHOLD = float(os.getenv("CLASSIFIER_LOW_THRESHOLD", 0.15))
+DEFAULT_HIGH_THRESHOLD = float(os.getenv("CLASSIFIER_HIGH_THRESHOLD", 0.85))
+
+# Every word adds a little evidence so long messages without keywords still reach the LLM
+LENGTH_WEIGHT = 0.01
+
+# (pattern, weight) features per BANT criterion
+FEATURES = {
+    "budget": [
+        (r"\bbudget\w*\b", 2.0),
+        (r"(\$|usd|eur|€|£|₹|\brs\.?)\s?\d", 2.0),
+        (r"\b\d[\d,.]*\s?(k|m|usd|dollars?|euros?|rupees?)\b", 2.0),
+        (r"\b(we|i) can (afford|spend|pay|invest)\b", 2.0),
+        (r"\b(price|pricing|cost|costs|quote|quotation|expensive|cheap|afford|payment|invoice|discount)\b", 0.8),
+    ],
+    "authority": [
+        (r"\bi('m| am) (the |a )?(owner|founder|co-?founder|ceo|cto|cfo|coo|director|head|manager|decision maker)\b", 2.0),
+        (r"\b(i|we) (decide|approve|sign off|make the call)\b", 2.0),
+        (r"\bmy (boss|manager|team|partner|board) (needs|has|have|will) to\b", 2.0),
+        (r"\b(owner|founder|ceo|cto|cfo|coo|director|vp|manager|procurement|purchasing|decision)\b", 0.8),
+    ],
+    "need": [
+        (r"\b(we|i) (really )?(need|require|am looking for|are looking for|want)\b", 2.0),
+        (r"\b(problem|issue|struggl\w*|pain|challenge|bottleneck)\b", 1.2),
+        (r"\b(interested|looking for|help|solution|improve|replace)\b", 0.8),
+    ],
+    "timeline": [
+        (r"\b(asap|urgent(ly)?|immediately|right away|deadline)\b", 2.0),
+        (r"\b(this|next) (week|month|quarter|year)\b", 2.0),
+        (r"\b(within|in) \d+ (days?|weeks?|months?)\b", 2.0),
+        (r"\bq[1-4]\b", 2.0),
+        (r"\b(soon|timeline|schedule|launch|start date|go live)\b", 0.8),
+    ],
+}
+COMPILED_FEATURES = {
+    criterion: [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in features]
+    for criterion, features in FEATURES.items()
+}
+
+# A local confirmation needs this many distinct features of the criterion to match
+MIN_CONFIRMING_FEATURES = int(os.getenv("CLASSIFIER_MIN_CONFIRMING_FEATURES", 2))
+# Negations and questions can turn any keyword around ("no budget", "what does budget mean?")
+NEGATION = re.compile(
+    r"(\?|\b(no|not|never|none|nothing|without|neither|nor|"
+    r"don'?t|doesn'?t|didn'?t|can'?t|cannot|won'?t|isn'?t|aren'?t|haven'?t|hasn'?t|wouldn'?t|shouldn'?t)\b)"
+)
+
+# Acknowledgements and greetings that never carry a BANT signal
+TRIVIAL_MESSAGE = re.compile(
+    r"^(ok(ay)?|k|yes|yeah|yep|no|nope|thanks?( you)?|thx|ty|hi|hello|hey|sure|great|cool|fine|good|bye|noted)$"
+)
+
+# Messages handled by each tier ("cache", "local", "llm"), overall and per org
+tier_counts = Counter()
+org_tier_counts = Counter()
+
+
+def _evidence(message_content: str, criteria: Iterable[str]) -> Tuple[str, Dict[str, float], Dict[str, int]]:
+    """Normalized text, 0..1 confidence per criterion, and the number of features each matched"""
+    text = " ".join(message_content.lower().split())
+    if TRIVIAL_MESSAGE.match(re.sub(r"[^\w\s]", "", text).strip()):
+        return text, {criterion: 0.0 for criterion in criteria}, {criterion: 0 for criterion in criteria}
+
+    prior = LENGTH_WEIGHT * len(text.split())
+    confidence, matched = {}, {}
+    for criterion in criteria:
+        weights = [weight for pattern, weight in COMPILED_FEATURES[criterion] if pattern.search(text)]
+        confidence[criterion] = round(1 - math.exp(-(prior + sum(weights))), 4)
+        matched[criterion] = len(weights)
+    return text, confidence, matched
+
+
+def score_message(message_content: str, criteria: Iterable[str]) -> Dict[str, float]:
+    """Return a 0..1 confidence that the message confirms each criterion"""
+    return _evidence(message_content, criteria)[1]
+
+
+def classify_locally(message_content: str, criteria: Iterable[str], low: float, high: float) -> Tuple[Dict[str, bool], Tuple[str, ...]]:
+    """
+    Settle the clear-cut criteria in-process.
+
+    Returns the decided criteria as {"<criterion>_confirmed": bool} and the
+    criteria whose confidence falls between the thresholds, which need the LLM.
+    Confirmations are permanent, so a criterion is only confirmed locally when
+    several of its features match in a message without negations or
+    questions; any other positive signal goes to the LLM.
+    """
+    text, confidence, matched = _evidence(message_content, criteria)
+    negated = NEGATION.search(text) is not None
+    decided = {}
+    ambiguous = []
+    for criterion, score in confidence.items():
+        if score >= high and matched[criterion] >= MIN_CONFIRMING_FEATURES and not negated:
+            decided[f"{criterion}_confirmed"] = True
+        elif score <= low:
+            decided[f"{criterion}_confirmed"] = False
+        else:
+            ambiguous.append(criterion)
+    return decided, tuple(ambiguous)
+
+
+def get_thresholds(organization) -> Tuple[float, float]:
+    """Resolve the (low, high) confidence thresholds for an organization"""
+    low = getattr(organization, "classifier_low_threshold", None)
+    high = getattr(organization, "classifier_high_threshold", None)
+    return (
+        DEFAULT_LOW_THRESHOLD if low is None else low,
+        DEFAULT_HIGH_THRESHOLD if high is None else high
+    )
+
+
+def record_tier(org_id: Optional[int], tier: str):
+    tier_counts[tier] += 1
+    org_tier_counts[(org_id, tier)] += 1
+
+
+def tier_stats() -> dict:
+    total = sum(tier_counts.values())
+    per_org = {}
+    for (org_id, tier), count in org_tier_counts.items():
+        per_org.setdefault(str(org_id), {})[tier] = count
+    return {
+        "total": total,
+        "counts": dict(tier_counts),
+        "share": {tier: round(count / total, 4) for tier, count in tier_counts.items()} if total else {},
+        "organizations": per_org
+    }
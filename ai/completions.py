@@ -0,0 +1,125 @@
+from sqlalchemy.orm import Session
+from db.models import Prompt, Contact
+from typing import Optional, Dict, Any, List, Callable
+from types import SimpleNamespace
+from ai.engine import client, execute_tool_calls, run_registry, RUN_DEADLINE
+from utils.metrics import metrics
+from utils.log import get_logger
+import asyncio
+from ai.governor import openai_call
+import os
+
+logger = get_logger(__name__)
+
+COMPLETIONS_MODEL = os.getenv("COMPLETIONS_MODEL", "gpt-4o")
+# Past exchanges (input + response pairs) replayed to the model on every reply
+HISTORY_TURNS = int(os.getenv("COMPLETIONS_HISTORY_TURNS", 20))
+# Upper bound on model -> tool -> model round trips for a single reply
+MAX_TOOL_ROUNDS = int(os.getenv("COMPLETIONS_MAX_TOOL_ROUNDS", 5))
+
+
+def build_chat_messages(db: Session, contact: Contact, instructions: str, input_text: str) -> List[Dict[str, Any]]:
+    """
+    Build the chat context from the org's instructions and the contact's stored Prompt history.
+    Turns already folded into the contact's rolling summary are replaced by that summary.
+    """
+    query = db.query(Prompt).filter(Prompt.contact_id == contact.id)
+    summary = contact.summary
+    if summary is not None and summary.summarized_until_prompt_id:
+        query = query.filter(Prompt.id > summary.summarized_until_prompt_id)
+    history = query.order_by(Prompt.id.desc()).limit(HISTORY_TURNS).all()
+
+    messages = [{"role": "system", "content": instructions}]
+    if summary is not None and summary.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary.summary}"})
+    for prompt in reversed(history):
+        if prompt.input_text:
+            messages.append({"role": "user", "content": prompt.input_text})
+        if prompt.response_text:
+            messages.append({"role": "assistant", "content": prompt.response_text})
+    messages.append({"role": "user", "content": input_text})
+    return messages
+
+
+async def stream_chat_completion(
+    messages: List[Dict[str, Any]],
+    tools: List[Dict[str, Any]],
+    execute_tool: Callable[[str, Dict[str, Any]], Any],
+    org_id: int = None
+) -> Optional[str]:
+    """
+    Answer with one streamed chat completion, running any requested function
+    tools and continuing the same request until the model produces text.
+    Returns None if the model keeps calling tools past MAX_TOOL_ROUNDS, ends
+    without any text, or the reply misses RUN_DEADLINE.
+    """
+    async with run_registry.track("chat_completion", org_id):
+        try:
+            return await asyncio.wait_for(_complete_with_tools(messages, tools, execute_tool, org_id), timeout=RUN_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.warning("Chat completion missed its deadline", extra={"org_id": org_id, "deadline_s": RUN_DEADLINE})
+            metrics.inc("assistant_run_deadline_exceeded", 1, org_id, "chat_completion")
+            return None
+
+
+async def _complete_with_tools(
+    messages: List[Dict[str, Any]],
+    tools: List[Dict[str, Any]],
+    execute_tool: Callable[[str, Dict[str, Any]], Any],
+    org_id: int = None
+) -> Optional[str]:
+    messages = list(messages)
+    estimated_tokens = sum(len(message.get("content") or "") for message in messages) // 4 + 500
+
+    for _ in range(MAX_TOOL_ROUNDS):
+        content = []
+        tool_calls = {}
+
+        async with openai_call("chat_completion", org_id, estimated_tokens=estimated_tokens) as call:
+            stream = await client.chat.completions.create(
+                model=COMPLETIONS_MODEL,
+                messages=messages,
+                tools=tools,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    call.usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content.append(delta.content)
+                for tool_delta in delta.tool_calls or []:
+                    # Tool calls stream in fragments keyed by their index
+                    tool_call = tool_calls.setdefault(tool_delta.index, {"id": None, "name": "", "arguments": ""})
+                    if tool_delta.id:
+                        tool_call["id"] = tool_delta.id
+                    if tool_delta.function and tool_delta.function.name:
+                        tool_call["name"] += tool_delta.function.name
+                    if tool_delta.function and tool_delta.function.arguments:
+                        tool_call["arguments"] += tool_delta.function.arguments
+
+        if not tool_calls:
+            # Tool calls followed by no text leave nothing to send; WhatsApp rejects an empty body
+            reply = "".join(content)
+            return reply if reply.strip() else None
+
+        requested = [
+            SimpleNamespace(id=tc["id"], function=SimpleNamespace(name=tc["name"], arguments=tc["arguments"]))
+            for _, tc in sorted(tool_calls.items())
+        ]
+        messages.append({
+            "role": "assistant",
+            "content": "".join(content) or None,
+            "tool_calls": [
+                {"id": tc.id, "type": "function", "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                for tc in requested
+            ]
+        })
+        for output in await execute_tool_calls(requested, execute_tool, org_id):
+            messages.append({"role": "tool", "tool_call_id": output["tool_call_id"], "content": output["output"]})
+
+    logger.warning("Chat completion exceeded the tool round limit", extra={"org_id": org_id, "max_tool_rounds": MAX_TOOL_ROUNDS})
+    return None
@@ -0,0 +1,245 @@
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from weakref import WeakValueDictionary
+from typing import Optional, Dict, Any, List, Callable
+import asyncio
+import json
+import time
+import os
+from utils.metrics import metrics, track
+from utils.jobs import RetryLater
+from utils.log import get_logger
+from ai.governor import openai_call
+
+load_dotenv()
+# Per-request bounds, so no single call can outlive the lease of the job that made it (JOB_VISIBILITY_TIMEOUT)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 30))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+client= AsyncOpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+logger = get_logger(__name__)
+
+# Terminal run events that mean the assistant will not produce a reply
+RUN_FAILED_EVENTS = ("thread.run.failed", "thread.run.cancelled", "thread.run.expired", "thread.run.incomplete")
+
+# Tool functions do blocking DB/HTTP work, so they run on a bounded pool
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT", 15))
+# Longest a run (including its tool calls) may take before it is cancelled
+RUN_DEADLINE = float(os.getenv("ASSISTANT_RUN_DEADLINE", 120))
+# Tokens reserved for a run before its real usage is known
+RUN_TOKEN_ESTIMATE = int(os.getenv("ASSISTANT_RUN_TOKEN_ESTIMATE", 3000))
+tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_WORKERS", 8)), thread_name_prefix="assistant-tool")
+
+
+class ShuttingDown(RetryLater):
+    """The process is draining and accepts no new runs"""
+
+
+class InFlightRun:
+    def __init__(self, kind: str, org_id: Optional[int], thread_id: Optional[str]):
+        self.kind = kind
+        self.org_id = org_id
+        self.thread_id = thread_id
+        self.run_id = None
+        self.started_at = time.monotonic()
+        self.task = asyncio.current_task()
+
+
+class RunRegistry:
+    """In-flight assistant runs and completions of this process, used for gauges and graceful drain"""
+
+    def __init__(self):
+        self.runs = set()
+        self.accepting = True
+        self._idle = None
+
+    @asynccontextmanager
+    async def track(self, kind: str, org_id: Optional[int] = None, thread_id: Optional[str] = None):
+        if not self.accepting:
+            raise ShuttingDown("Not accepting new runs while shutting down")
+        run = InFlightRun(kind, org_id, thread_id)
+        self.runs.add(run)
+        try:
+            yield run
+        finally:
+            self.runs.discard(run)
+            if not self.runs and self._idle is not None:
+                self._idle.set()
+
+    def begin_shutdown(self):
+        self.accepting = False
+
+    async def drain(self, timeout: float) -> int:
+        """Wait up to `timeout` seconds for in-flight runs to finish; returns how many are left"""
+        if self.runs:
+            self._idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return len(self.runs)
+
+    def cancel_all(self):
+        """Cancel the remaining runs; they cancel themselves on OpenAI and their jobs are requeued"""
+        for run in list(self.runs):
+            if run.task is not None:
+                run.task.cancel()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        ages = sorted((now - run.started_at for run in self.runs), reverse=True)
+        return {
+            "accepting": self.accepting,
+            "active": len(self.runs),
+            "oldest_age_seconds": round(ages[0], 1) if ages else 0,
+            "runs": [
+                {
+                    "kind": run.kind,
+                    "org_id": run.org_id,
+                    "thread_id": run.thread_id,
+                    "run_id": run.run_id,
+                    "age_seconds": round(now - run.started_at, 1)
+                }
+                for run in sorted(self.runs, key=lambda run: run.started_at)
+            ]
+        }
+
+
+run_registry = RunRegistry()
+metrics.register_collector("inflight_runs", run_registry.stats)
+
+
+# One lock per OpenAI thread: a thread accepts neither messages nor a second run while a run is active
+_thread_locks = WeakValueDictionary()
+
+
+def thread_lock(thread_id: str) -> asyncio.Lock:
+    """Return the lock serializing message posts and runs on `thread_id` in this process"""
+    lock = _thread_locks.get(thread_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _thread_locks[thread_id] = lock
+    return lock
+
+
+async def run_tool_call(tool_call, execute_tool: Callable[[str, Dict[str, Any]], Any], org_id: int = None) -> Dict[str, str]:
+    """Execute one tool call on the tool executor, isolating its errors and enforcing a timeout"""
+    function_name = tool_call.function.name
+    try:
+        arguments = json.loads(tool_call.function.arguments or "{}")
+        loop = asyncio.get_running_loop()
+        with track(function_name, org_id, metric="tool_call_latency_ms"):
+            result = await asyncio.wait_for(
+                loop.run_in_executor(tool_executor, execute_tool, function_name, arguments),
+                timeout=TOOL_CALL_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        logger.warning("Tool call timed out", extra={"tool": function_name, "org_id": org_id, "timeout_s": TOOL_CALL_TIMEOUT})
+        result = {"error": f"{function_name} timed out"}
+    except Exception as e:
+        logger.error("Tool call failed", extra={"tool": function_name, "org_id": org_id, "error": str(e)})
+        result = {"error": "Internal processing error"}
+    return {
+        "tool_call_id": tool_call.id,
+        "output": json.dumps(result)
+    }
+
+
+async def execute_tool_calls(tool_calls, execute_tool: Callable[[str, Dict[str, Any]], Any], org_id: int = None) -> List[Dict[str, str]]:
+    """Run all tool calls of a requires_action step concurrently, keeping their order"""
+    return list(await asyncio.gather(*(run_tool_call(tool_call, execute_tool, org_id) for tool_call in tool_calls)))
+
+
+async def cancel_run(thread_id: str, run_id: Optional[str]):
+    """Best-effort cancellation of a run on OpenAI's side"""
+    if not run_id:
+        return
+    try:
+        await client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+    except Exception as e:
+        logger.warning("Could not cancel run", extra={"run_id": run_id, "thread_id": thread_id, "error": str(e)})
+
+
+async def stream_assistant_run(
+    thread_id: str,
+    assistant_id: str,
+    tools: List[Dict[str, Any]],
+    execute_tool: Callable[[str, Dict[str, Any]], Any],
+    additional_instructions: Optional[str] = None,
+    org_id: int = None
+) -> Optional[str]:
+    """
+    Run the assistant on a thread using streamed run events.
+
+    Tool calls arrive inline as a requires_action event; their outputs are
+    submitted on a new stream and the loop continues until the run ends.
+    Returns the text of the last completed assistant message, or None when
+    the run fails, is cancelled, expires or misses RUN_DEADLINE (in which
+    case it is cancelled on OpenAI as well).
+    """
+    run_options = {"additional_instructions": additional_instructions} if additional_instructions else {}
+
+    async def consume(inflight: InFlightRun, tracked) -> Optional[str]:
+        reply = None
+        manager = client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            tools=tools,
+            **run_options
+        )
+
+        while manager is not None:
+            tool_outputs = None
+            metrics.inc("assistant_run_streams", 1, org_id, "assistant_run")
+
+            async with manager as stream:
+                async for event in stream:
+                    if event.event == "thread.run.created":
+                        inflight.run_id = event.data.id
+
+                    elif event.event == "thread.message.completed":
+                        texts = [part.text.value for part in event.data.content if part.type == "text"]
+                        if texts:
+                            reply = "\n".join(texts)
+
+                    elif event.event == "thread.run.requires_action":
+                        inflight.run_id = event.data.id
+                        tool_outputs = await execute_tool_calls(
+                            event.data.required_action.submit_tool_outputs.tool_calls,
+                            execute_tool,
+                            org_id
+                        )
+
+                    elif event.event == "thread.run.completed":
+                        tracked.usage(event.data.usage)
+
+                    elif event.event in RUN_FAILED_EVENTS:
+                        logger.warning("Run ended without a reply", extra={"status": event.data.status, "run_id": inflight.run_id, "org_id": org_id})
+                        tracked.usage(event.data.usage)
+                        metrics.inc("assistant_run_failures", 1, org_id, event.data.status)
+                        return None
+
+            manager = None
+            if tool_outputs is not None:
+                manager = client.beta.threads.runs.submit_tool_outputs_stream(
+                    thread_id=thread_id,
+                    run_id=inflight.run_id,
+                    tool_outputs=tool_outputs
+                )
+        return reply
+
+    async with run_registry.track("assistant_run", org_id, thread_id) as inflight:
+        # The run holds one admission slot from creation until its final event
+        async with openai_call("assistant_run", org_id, estimated_tokens=RUN_TOKEN_ESTIMATE) as tracked:
+            try:
+                return await asyncio.wait_for(consume(inflight, tracked), timeout=RUN_DEADLINE)
+            except asyncio.TimeoutError:
+                logger.warning("Run missed its deadline", extra={"run_id": inflight.run_id, "thread_id": thread_id, "org_id": org_id, "deadline_s": RUN_DEADLINE})
+                metrics.inc("assistant_run_deadline_exceeded", 1, org_id, "assistant_run")
+                await cancel_run(thread_id, inflight.run_id)
+                return None
+            except asyncio.CancelledError:
+                # Shutdown or caller cancellation: don't leave the thread locked by an orphaned run
+                await asyncio.shield(cancel_run(thread_id, inflight.run_id))
+                raise
@@ -0,0 +1,241 @@
+from collections import Counter, defaultdict, deque
+from typing import Optional
+from utils.metrics import metrics, track
+import asyncio
+import time
+import os
+
+
+class GovernorOverloaded(Exception):
+    """The OpenAI admission queue is full or the wait for a slot timed out"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate_per_minute`, holding at most `capacity` (a minute's worth by default)"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.capacity = rate_per_minute if capacity is None else capacity
+        self.tokens = self.capacity
+        self.rate = rate_per_minute / 60
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken (requests larger than the bucket only need a full one)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def adjust(self, amount: float):
+        """Charge (positive) or refund (negative) the difference once the real cost is known"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class Permit:
+    def __init__(self, org_id, tokens: int):
+        self.org_id = org_id
+        self.tokens = tokens
+
+
+class OpenAIGovernor:
+    """
+    Admission control for OpenAI calls.
+
+    Callers wait in a per-org FIFO queue. Slots are granted round-robin across
+    orgs, within the global and per-org concurrency caps and the global and
+    per-org request and token budgets (token buckets refilled per minute).
+    A full org queue or a wait longer than `admit_timeout` raises
+    GovernorOverloaded so the caller can back off.
+    """
+
+    def __init__(
+        self,
+        global_concurrency: int = 32,
+        org_concurrency: int = 4,
+        global_rpm: float = 3000,
+        org_rpm: float = 600,
+        global_tpm: float = 800000,
+        org_tpm: float = 200000,
+        max_queue_per_org: int = 200,
+        admit_timeout: float = 60
+    ):
+        self.global_concurrency = global_concurrency
+        self.org_concurrency = org_concurrency
+        self.org_rpm = org_rpm
+        self.org_tpm = org_tpm
+        self.max_queue_per_org = max_queue_per_org
+        self.admit_timeout = admit_timeout
+        self.global_requests = TokenBucket(global_rpm)
+        self.global_tokens = TokenBucket(global_tpm)
+        self.org_requests = {}
+        self.org_tokens = {}
+        self.active = 0
+        self.org_active = Counter()
+        self.rejected = Counter()
+        self._waiters = defaultdict(deque)
+        self._ready_orgs = deque()
+        self._timer = None
+
+    def _buckets(self, org_id):
+        if org_id not in self.org_requests:
+            self.org_requests[org_id] = TokenBucket(self.org_rpm)
+            self.org_tokens[org_id] = TokenBucket(self.org_tpm)
+        return self.org_requests[org_id], self.org_tokens[org_id]
+
+    async def acquire(self, org_id, tokens: int = 0, operation: str = "") -> Permit:
+        queue = self._waiters[org_id]
+        if len(queue) >= self.max_queue_per_org:
+            self.rejected[org_id] += 1
+            metrics.inc("openai_admission_rejected", 1, org_id, operation)
+            raise GovernorOverloaded(f"OpenAI queue for org {org_id} is full")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append((future, tokens))
+        if org_id not in self._ready_orgs:
+            self._ready_orgs.append(org_id)
+        started_at = time.perf_counter()
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(future, timeout=self.admit_timeout)
+        except asyncio.TimeoutError:
+            self.rejected[org_id] += 1
+            metrics.inc("openai_admission_rejected", 1, org_id, operation)
+            raise GovernorOverloaded(f"Timed out waiting for an OpenAI slot for org {org_id}")
+        except asyncio.CancelledError:
+            # Granted right before the cancellation landed: hand the slot back
+            if future.done() and not future.cancelled():
+                self.release(Permit(org_id, tokens))
+            raise
+        finally:
+            metrics.observe("openai_queue_wait_ms", (time.perf_counter() - started_at) * 1000, org_id, operation)
+        return Permit(org_id, tokens)
+
+    def release(self, permit: Permit):
+        self.active -= 1
+        self.org_active[permit.org_id] -= 1
+        self._dispatch()
+
+    def settle(self, permit: Permit, actual_tokens: Optional[int]):
+        """Correct the token budgets once the response reports its real usage"""
+        if actual_tokens is None:
+            return
+        delta = actual_tokens - permit.tokens
+        self.global_tokens.adjust(delta)
+        self._buckets(permit.org_id)[1].adjust(delta)
+        permit.tokens = actual_tokens
+
+    def _dispatch(self):
+        retry_in = None
+        granted = True
+        while granted and self.active < self.global_concurrency:
+            granted = False
+            for _ in range(len(self._ready_orgs)):
+                if self.active >= self.global_concurrency:
+                    break
+                org_id = self._ready_orgs.popleft()
+                queue = self._waiters[org_id]
+                while queue and queue[0][0].done():
+                    queue.popleft()  # Waiter timed out or was cancelled
+                if not queue:
+                    del self._waiters[org_id]
+                    continue
+                if self.org_active[org_id] >= self.org_concurrency:
+                    self._ready_orgs.append(org_id)
+                    continue
+
+                future, tokens = queue[0]
+                org_requests, org_tokens = self._buckets(org_id)
+                wait = max(
+                    self.global_requests.wait_time(1), org_requests.wait_time(1),
+                    self.global_tokens.wait_time(tokens), org_tokens.wait_time(tokens)
+                )
+                if wait > 0:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    self._ready_orgs.append(org_id)
+                    continue
+
+                for bucket, amount in ((self.global_requests, 1), (org_requests, 1), (self.global_tokens, tokens), (org_tokens, tokens)):
+                    bucket.take(amount)
+                queue.popleft()
+                self.active += 1
+                self.org_active[org_id] += 1
+                future.set_result(None)
+                granted = True
+                if queue:
+                    self._ready_orgs.append(org_id)
+                else:
+                    del self._waiters[org_id]
+
+        if retry_in is not None and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(retry_in, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": sum(len(queue) for queue in self._waiters.values()),
+            "organizations": {
+                str(org_id): {"active": self.org_active[org_id], "queued": len(self._waiters.get(org_id, ()))}
+                for org_id in set(self.org_active) | set(self._waiters)
+                if self.org_active[org_id] or self._waiters.get(org_id)
+            },
+            "rejected": {str(org_id): count for org_id, count in self.rejected.items()}
+        }
+
+
+governor = OpenAIGovernor(
+    global_concurrency=int(os.getenv("OPENAI_GLOBAL_CONCURRENCY", 32)),
+    org_concurrency=int(os.getenv("OPENAI_ORG_CONCURRENCY", 4)),
+    global_rpm=float(os.getenv("OPENAI_GLOBAL_RPM", 3000)),
+    org_rpm=float(os.getenv("OPENAI_ORG_RPM", 600)),
+    global_tpm=float(os.getenv("OPENAI_GLOBAL_TPM", 800000)),
+    org_tpm=float(os.getenv("OPENAI_ORG_TPM", 200000)),
+    max_queue_per_org=int(os.getenv("OPENAI_MAX_QUEUE_PER_ORG", 200)),
+    admit_timeout=float(os.getenv("OPENAI_ADMIT_TIMEOUT", 60))
+)
+metrics.register_collector("openai_governor", governor.stats)
+
+
+class openai_call:
+    """
+    Admit an OpenAI call through the governor and record its latency and usage.
+
+        async with openai_call("bant_classifier", org_id, estimated_tokens=500) as call:
+            response = await client.chat.completions.create(...)
+            call.usage(response.usage)
+    """
+
+    def __init__(self, operation: str, org_id: Optional[int] = None, estimated_tokens: int = 0):
+        self.operation = operation
+        self.org_id = org_id
+        self.estimated_tokens = estimated_tokens
+
+    def usage(self, usage):
+        self.tracked.usage(usage)
+        if usage is not None:
+            governor.settle(self.permit, getattr(usage, "total_tokens", None))
+
+    async def __aenter__(self):
+        self.permit = await governor.acquire(self.org_id, self.estimated_tokens, self.operation)
+        self.tracked = track(self.operation, self.org_id).__enter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            self.tracked.__exit__(exc_type, exc, tb)
+        finally:
+            governor.release(self.permit)
+        return False
@@ -0,0 +1,196 @@
+"""
+Re-score historical conversations with the current BANT rubric.
+
+    python -m ai.rescore --org 3 --name rubric-v2 [--chunk 2000] [--concurrency 8]
+
+Prompts are streamed per org in keyset-paginated chunks ordered by contact,
+each contact's inbound messages are scored with one classifier request
+(at most --concurrency in flight), and the results replace the contacts'
+LeadQualification rows in one bulk write per chunk. Progress is stored in
+`rescore_runs` under --name, so rerunning the same command resumes after the
+last completed chunk.
+"""
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import Session
+from db.models import SessionLocal, Prompt, LeadQualification, RescoreRun
+from db.migrations import migrate
+from ai.app import BANT_CRITERIA, analyze_qualification_criteria, score_qualification
+from itertools import groupby
+from typing import List, Optional, Tuple
+from utils.log import configure_logging, stop_logging, get_logger
+import argparse
+import asyncio
+import os
+
+logger = get_logger(__name__)
+
+RESCORE_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", 2000))
+RESCORE_CONCURRENCY = int(os.getenv("RESCORE_CONCURRENCY", 8))
+# Longer histories keep their most recent messages
+RESCORE_MAX_CHARS = int(os.getenv("RESCORE_MAX_CHARS", 12000))
+
+
+def get_run(db: Session, name: str, org_id: int) -> RescoreRun:
+    run = db.query(RescoreRun).filter(RescoreRun.name == name).first()
+    if run is None:
+        run = RescoreRun(name=name, org_id=org_id, last_contact_id=0, contacts_scored=0, prompts_scored=0, failures=0)
+        db.add(run)
+        db.commit()
+    elif run.org_id != org_id:
+        raise SystemExit(f"Rescore run '{name}' belongs to org {run.org_id}")
+    return run
+
+
+def run_stats(run: RescoreRun) -> dict:
+    return {
+        "name": run.name,
+        "org_id": run.org_id,
+        "last_contact_id": run.last_contact_id,
+        "contacts_scored": run.contacts_scored,
+        "prompts_scored": run.prompts_scored,
+        "failures": run.failures,
+        "status": run.status
+    }
+
+
+def fetch_chunk(db: Session, org_id: int, after: Tuple[int, Optional[int]], size: int) -> List[Tuple[int, int, str]]:
+    """
+    Next `size` (contact_id, prompt_id, input_text) rows after the (contact_id, prompt_id) cursor;
+    a prompt_id of None starts after every prompt of that contact.
+    """
+    contact_id, prompt_id = after
+    if prompt_id is None:
+        position = Prompt.contact_id > contact_id
+    else:
+        position = or_(
+            Prompt.contact_id > contact_id,
+            and_(Prompt.contact_id == contact_id, Prompt.id > prompt_id)
+        )
+    return db.query(Prompt.contact_id, Prompt.id, Prompt.input_text).filter(
+        Prompt.organization_id == org_id,
+        Prompt.contact_id.isnot(None),
+        position
+    ).order_by(Prompt.contact_id, Prompt.id).limit(size).all()
+
+
+def build_transcript(messages: List[str]) -> str:
+    transcript = "\n".join(message for message in messages if message)
+    return transcript[-RESCORE_MAX_CHARS:]
+
+
+async def score_contact(contact_id: int, rows: List[Tuple[int, int, str]], org_id: int, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    """Classify one contact's whole history; returns the LeadQualification values or None on failure"""
+    transcript = build_transcript([input_text for _, _, input_text in rows])
+    analysis = {}
+    if transcript:
+        async with semaphore:
+            try:
+                analysis = await analyze_qualification_criteria(transcript, detect_type=True, org_id=org_id)
+            except Exception as e:
+                logger.warning("Could not re-score contact", extra={"contact_id": contact_id, "error": str(e)})
+                return None
+
+    confirmed = {criterion: bool(analysis.get(f"{criterion}_confirmed")) for criterion in BANT_CRITERIA}
+    score, meeting_readiness = score_qualification(confirmed)
+    values = {f"{criterion}_confirmed": value for criterion, value in confirmed.items()}
+    values.update({
+        "contact_id": contact_id,
+        "qualification_score": score,
+        "meeting_readiness": meeting_readiness,
+        "detected_type": analysis.get("detected_type") if analysis.get("detected_type") in ("B2B", "B2C") else None,
+        "last_prompt_id": rows[-1][1]
+    })
+    return values
+
+
+def write_results(db: Session, results: List[dict]):
+    """Replace the qualification state of every re-scored contact with one bulk update and insert"""
+    existing = dict(db.query(LeadQualification.contact_id, LeadQualification.id).filter(
+        LeadQualification.contact_id.in_([values["contact_id"] for values in results])
+    ).all())
+    updates = [{**values, "id": existing[values["contact_id"]]} for values in results if values["contact_id"] in existing]
+    inserts = [values for values in results if values["contact_id"] not in existing]
+    if updates:
+        db.bulk_update_mappings(LeadQualification, updates)
+    if inserts:
+        db.bulk_insert_mappings(LeadQualification, inserts)
+
+
+async def rescore_org(org_id: int, name: str, chunk_size: int = RESCORE_CHUNK_SIZE, concurrency: int = RESCORE_CONCURRENCY) -> dict:
+    db = SessionLocal()
+    try:
+        run = get_run(db, name, org_id)
+        if run.status == "done":
+            logger.info("Rescore run already finished", extra={"run": name})
+            return run_stats(run)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        # A contact whose prompts were cut off by the chunk limit is carried into the next chunk
+        carry = []
+        # The checkpointed contact is fully scored, so resume with the next one
+        cursor = (run.last_contact_id, None)
+        while True:
+            rows = fetch_chunk(db, org_id, cursor, chunk_size)
+            exhausted = len(rows) < chunk_size
+            if rows:
+                cursor = rows[-1][:2]
+            rows = carry + rows
+
+            groups = [(contact_id, list(group)) for contact_id, group in groupby(rows, key=lambda row: row[0])]
+            carry = []
+            if not exhausted and groups:
+                carry = groups.pop()[1]
+            if not groups:
+                if exhausted:
+                    break
+                continue
+
+            results = await asyncio.gather(*(
+                score_contact(contact_id, group, org_id, semaphore) for contact_id, group in groups
+            ))
+            scored = [values for values in results if values is not None]
+            write_results(db, scored)
+            run.last_contact_id = groups[-1][0]
+            run.contacts_scored += len(scored)
+            run.prompts_scored += sum(len(group) for _, group in groups)
+            run.failures += len(results) - len(scored)
+            db.commit()
+            logger.info("Rescore checkpoint", extra={
+                "run": name,
+                "last_contact_id": run.last_contact_id,
+                "contacts_scored": run.contacts_scored,
+                "failures": run.failures
+            })
+
+            if exhausted:
+                break
+
+        run.status = "done"
+        db.commit()
+        return run_stats(run)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score an organization's conversations with the current BANT rubric")
+    parser.add_argument("--org", type=int, required=True, help="Organization id")
+    parser.add_argument("--name", required=True, help="Checkpoint name; rerun with the same name to resume")
+    parser.add_argument("--chunk", type=int, default=RESCORE_CHUNK_SIZE, help="Prompt rows read per chunk")
+    parser.add_argument("--concurrency", type=int, default=RESCORE_CONCURRENCY, help="Classifier requests in flight")
+    args = parser.parse_args()
+
+    configure_logging()
+    try:
+        migrate()
+        stats = asyncio.run(rescore_org(args.org, args.name, args.chunk, args.concurrency))
+        logger.info("Rescore run finished", extra={"run": stats})
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from db.models import SessionLocal, Contact, Organization, Prompt, ConversationSummary
+from ai.engine import client, thread_lock
+from ai.governor import openai_call
+from utils.jobs import job_queue
+from wp.contact_cache import invalidate_contact
+from typing import List, Optional
+import os
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+# Compact once this many turns, or roughly this many tokens, are outside the summary
+SUMMARY_TRIGGER_TURNS = int(os.getenv("SUMMARY_TRIGGER_TURNS", 30))
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", 6000))
+# Most recent turns that are always sent verbatim
+KEEP_RECENT_TURNS = int(os.getenv("SUMMARY_KEEP_RECENT_TURNS", 6))
+
+SUMMARY_INSTRUCTIONS = """You maintain a running summary of a WhatsApp sales conversation between
+an assistant and a prospect. Merge the previous summary with the new turns. Keep every fact that
+matters for the sale: the prospect's needs, budget, decision makers, timeline, products and prices
+discussed, objections, commitments and open questions. Write at most 250 words."""
+
+
+def get_summary(db: Session, contact: Contact) -> Optional[ConversationSummary]:
+    return db.query(ConversationSummary).filter(ConversationSummary.contact_id == contact.id).first()
+
+
+def unsummarized_prompts(db: Session, contact_id: int, summary: Optional[ConversationSummary]):
+    query = db.query(Prompt).filter(Prompt.contact_id == contact_id)
+    if summary is not None and summary.summarized_until_prompt_id:
+        query = query.filter(Prompt.id > summary.summarized_until_prompt_id)
+    return query
+
+
+def schedule_compaction(db: Session, contact: Contact):
+    """Queue a compaction job once the contact's unsummarized history crosses a threshold"""
+    summary = get_summary(db, contact)
+    turns, characters = unsummarized_prompts(db, contact.id, summary).with_entities(
+        func.count(Prompt.id),
+        func.coalesce(func.sum(func.length(Prompt.input_text) + func.length(Prompt.response_text)), 0)
+    ).one()
+    if turns <= KEEP_RECENT_TURNS:
+        return
+    if turns >= SUMMARY_TRIGGER_TURNS or characters // 4 >= SUMMARY_TRIGGER_TOKENS:
+        # Grouped with the contact's inbound messages so it never runs next to a reply
+        job_queue.enqueue(
+            "summarize_conversation",
+            {"contact_id": contact.id},
+            db=db,
+            group_key=f"contact:{contact.id}",
+            unique=True
+        )
+
+
+def format_transcript(prompts: List[Prompt]) -> str:
+    lines = []
+    for prompt in prompts:
+        if prompt.input_text:
+            lines.append(f"Prospect: {prompt.input_text}")
+        if prompt.response_text:
+            lines.append(f"Assistant: {prompt.response_text}")
+    return "\n".join(lines)
+
+
+async def summarize(previous_summary: Optional[str], prompts: List[Prompt], org_id: int) -> str:
+    content = f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{format_transcript(prompts)}"
+    async with openai_call("conversation_summary", org_id, estimated_tokens=len(content) // 4 + 400) as call:
+        response = await client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": content}
+            ]
+        )
+        call.usage(response.usage)
+    return response.choices[0].message.content
+
+
+async def roll_thread(contact: Contact, organization: Organization, summary: str, recent: List[Prompt]) -> str:
+    """Start a fresh assistant thread seeded with the summary and the recent turns"""
+    messages = [{"role": "assistant", "content": f"Summary of the conversation so far:\n{summary}"}]
+    for prompt in recent:
+        if prompt.input_text:
+            messages.append({"role": "user", "content": prompt.input_text})
+        if prompt.response_text:
+            messages.append({"role": "assistant", "content": prompt.response_text})
+
+    options = {}
+    if organization.vspace_id:
+        options["tool_resources"] = {"file_search": {"vector_store_ids": [organization.vspace_id]}}
+    async with openai_call("threads.create", organization.id):
+        thread = await client.beta.threads.create(messages=messages, **options)
+    return thread.id
+
+
+@job_queue.handler("summarize_conversation")
+async def compact_conversation(payload: dict):
+    """Fold the contact's older turns into the stored summary; a no-op if already compacted"""
+    db = SessionLocal()
+    try:
+        contact = db.query(Contact).filter(Contact.id == payload["contact_id"]).first()
+        if not contact:
+            return
+        organization = db.query(Organization).filter(Organization.id == contact.org_id).first()
+        summary = get_summary(db, contact)
+        prompts = unsummarized_prompts(db, contact.id, summary).order_by(Prompt.id).all()
+        if len(prompts) <= KEEP_RECENT_TURNS:
+            return
+
+        older, recent = prompts[:-KEEP_RECENT_TURNS], prompts[-KEEP_RECENT_TURNS:]
+        text = await summarize(summary.summary if summary else None, older, contact.org_id)
+
+        if summary is None:
+            summary = ConversationSummary(contact_id=contact.id, turns_summarized=0, compactions=0)
+            db.add(summary)
+        summary.summary = text
+        summary.summarized_until_prompt_id = older[-1].id
+        summary.turns_summarized = (summary.turns_summarized or 0) + len(older)
+        summary.compactions = (summary.compactions or 0) + 1
+
+        # Assistants-engine contacts keep their history server-side, so move them to a bounded thread
+        if organization and organization.conversation_engine != "completions" and contact.thread_id:
+            async with thread_lock(contact.thread_id):
+                contact.thread_id = await roll_thread(contact, organization, text, recent)
+        db.commit()
+        invalidate_contact(contact.phone_number, contact.org_id)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
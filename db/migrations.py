@@ -0,0 +1,185 @@
+"""
+Versioned schema migrations.
+
+Applied versions are recorded in the `schema_version` table and every
+migration runs in its own transaction together with its version row.
+Version 1 creates missing tables from the current models, so a fresh
+database already has what later versions add: every later migration must
+be a no-op on a schema that already contains its change.
+
+    python -m db.migrations           # apply pending migrations
+    python -m db.migrations --status  # list applied and pending versions
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from db.models import Base, engine
+from utils.phone import normalize_phone
+from utils.log import get_logger, configure_logging, stop_logging
+from typing import Callable, List, Tuple
+import argparse
+
+logger = get_logger(__name__)
+
+BACKFILL_CHUNK = 1000
+
+
+def _initial_schema(conn: Connection):
+    Base.metadata.create_all(bind=conn)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> bool:
+    if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def _added_columns(conn: Connection):
+    """Columns added to existing tables after they were first created"""
+    _add_column(conn, "organizations", "classifier_low_threshold", "FLOAT")
+    _add_column(conn, "organizations", "classifier_high_threshold", "FLOAT")
+    _add_column(conn, "organizations", "conversation_engine", "VARCHAR(20) DEFAULT 'assistants'")
+    _add_column(conn, "jobs", "group_key", "VARCHAR(100)")
+    _add_column(conn, "outbound_messages", "delivered_at", "DATETIME")
+    _add_column(conn, "outbound_messages", "read_at", "DATETIME")
+    _add_column(conn, "outbound_messages", "campaign_id", "INTEGER REFERENCES campaigns (id)")
+    _add_column(conn, "outbound_messages", "priority", "INTEGER DEFAULT 0 NOT NULL")
+    _add_column(conn, "contacts", "phone_e164", "VARCHAR(20)")
+    # ADD COLUMN cannot carry a UNIQUE constraint; a unique index enforces it instead
+    if _add_column(conn, "organization_keys", "phone_number_id", "VARCHAR(50)"):
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_organization_keys_phone_number_id "
+            "ON organization_keys (phone_number_id)"
+        ))
+
+
+def _backfill_phone_e164(conn: Connection):
+    """Normalize the phone numbers of contacts stored before phone_e164 existed"""
+    last_id = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, phone_number FROM contacts "
+            "WHERE id > :last_id AND phone_e164 IS NULL AND phone_number IS NOT NULL "
+            "ORDER BY id LIMIT :size"
+        ), {"last_id": last_id, "size": BACKFILL_CHUNK}).all()
+        if not rows:
+            return
+        updates = [
+            {"id": contact_id, "phone_e164": normalize_phone(phone_number)}
+            for contact_id, phone_number in rows
+        ]
+        updates = [update for update in updates if update["phone_e164"]]
+        if updates:
+            conn.execute(text("UPDATE contacts SET phone_e164 = :phone_e164 WHERE id = :id"), updates)
+        last_id = rows[-1][0]
+
+
+# Index name -> (table, columns), for the filters on the request and worker hot paths
+INDEXES = {
+    "ix_contacts_org_phone": ("contacts", "org_id, phone_e164"),
+    "ix_prompts_contact": ("prompts", "contact_id, id"),
+    "ix_prompts_org_contact": ("prompts", "organization_id, contact_id, id"),
+    "ix_products_org_id": ("products", "org_id"),
+    "ix_products_user_id": ("products", "user_id"),
+    "ix_organization_invites_org_email": ("organization_invites", "organization_id, email"),
+    "ix_organization_members_user": ("organization_members", "user_id, organization_id"),
+    "ix_organization_members_org": ("organization_members", "organization_id, user_id"),
+    "ix_contact_groups_contact": ("contact_groups", "contact_id, group_id"),
+    "ix_contact_groups_group": ("contact_groups", "group_id, contact_id"),
+    "ix_contact_tags_contact": ("contact_tags", "contact_id, tag_id"),
+    "ix_contact_tags_tag": ("contact_tags", "tag_id, contact_id"),
+    "ix_jobs_group_key": ("jobs", "group_key"),
+    "ix_outbound_messages_campaign_id": ("outbound_messages", "campaign_id"),
+}
+
+
+def _hot_path_indexes(conn: Connection):
+    for name, (table, columns) in INDEXES.items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _sender_lookup_index(conn: Connection):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_contacts_phone_e164 ON contacts (phone_e164)"))
+
+
+def _posted_messages(conn: Connection):
+    _add_column(conn, "processed_messages", "posted_at", "DATETIME")
+
+
+def _outbox_claim_indexes(conn: Connection):
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_outbound_messages_recipient ON outbound_messages (phone_number_id, to_phone, id)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbound_messages_claim ON outbound_messages (status, priority, id)"))
+
+
+def _recorded_replies(conn: Connection):
+    _add_column(conn, "processed_messages", "reply_text", "TEXT")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Initial schema", _initial_schema),
+    (2, "Columns added to existing tables", _added_columns),
+    (3, "Backfill contacts.phone_e164", _backfill_phone_e164),
+    (4, "Indexes for hot access paths", _hot_path_indexes),
+    (5, "Index contacts.phone_e164 for single-tenant sender lookups", _sender_lookup_index),
+    (6, "Track which inbound messages reached the OpenAI thread", _posted_messages),
+    (7, "Indexes for outbox claims", _outbox_claim_indexes),
+    (8, "Keep generated replies until they are stored and queued", _recorded_replies),
+]
+
+
+def _ensure_version_table(bind: Engine):
+    with bind.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(255) NOT NULL, "
+            "applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+        ))
+
+
+def applied_versions(bind: Engine = engine) -> List[int]:
+    _ensure_version_table(bind)
+    with bind.connect() as conn:
+        return [version for (version,) in conn.execute(text("SELECT version FROM schema_version ORDER BY version"))]
+
+
+def migrate(bind: Engine = engine) -> List[int]:
+    """Apply every pending migration in order; returns the versions applied"""
+    done = set(applied_versions(bind))
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if version in done:
+            continue
+        with bind.begin() as conn:
+            apply(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description}
+            )
+        logger.info("Applied migration", extra={"version": version, "description": description})
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--status", action="store_true", help="List applied and pending versions without migrating")
+    args = parser.parse_args()
+
+    configure_logging()
+    try:
+        if args.status:
+            done = set(applied_versions())
+            for version, description, _ in MIGRATIONS:
+                print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {description}")
+        else:
+            applied = migrate()
+            print(f"Applied {len(applied)} migration(s); schema at version {MIGRATIONS[-1][0]}")
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Text, Float
-from sqlalchemy.orm import relationship, declarative_base, sessionmaker
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Text, Float, Index
+from sqlalchemy.orm import relationship, declarative_base, sessionmaker, validates
 from datetime import datetime
 from sqlalchemy import create_engine
 from passlib.context import CryptContext
+from utils.phone import normalize_phone
 
 # Database connection
 engine = create_engine("sqlite:///test.db")
@@ -22,7 +23,9 @@ organization_members = Table(
     'organization_members',
     Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('organization_id', Integer, ForeignKey('organizations.id'))
+    Column('organization_id', Integer, ForeignKey('organizations.id')),
+    Index('ix_organization_members_user', 'user_id', 'organization_id'),
+    Index('ix_organization_members_org', 'organization_id', 'user_id')
 )
 
 # Add this association table for Contact-Group many-to-many relationship
@@ -30,7 +33,9 @@ contact_groups = Table(
     'contact_groups',
     Base.metadata,
     Column('contact_id', Integer, ForeignKey('contacts.id')),
-    Column('group_id', Integer, ForeignKey('groups.id'))
+    Column('group_id', Integer, ForeignKey('groups.id')),
+    Index('ix_contact_groups_contact', 'contact_id', 'group_id'),
+    Index('ix_contact_groups_group', 'group_id', 'contact_id')
 )
 
 # Add this near the top of the file with your other association tables
@@ -38,7 +43,9 @@ contact_tags = Table(
     'contact_tags',
     Base.metadata,
     Column('contact_id', Integer, ForeignKey('contacts.id')),
-    Column('tag_id', Integer, ForeignKey('tags.id'))
+    Column('tag_id', Integer, ForeignKey('tags.id')),
+    Index('ix_contact_tags_contact', 'contact_id', 'tag_id'),
+    Index('ix_contact_tags_tag', 'tag_id', 'contact_id')
 )
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -88,6 +95,9 @@ class Organization(Base):
     assistant_id= Column(String(50), unique=True, nullable=True)
     business_model = Column(String(10), nullable=False)  # "B2B", "B2C", or "BOTH"
     meeting_url= Column(String(100), nullable=True)
+    classifier_low_threshold= Column(Float, nullable=True)  # Local BANT scorer thresholds, None uses the defaults
+    classifier_high_threshold= Column(Float, nullable=True)
+    conversation_engine= Column(String(20), default="assistants", nullable=True)  # "assistants" or "completions"
     # Relationships
     root_user= relationship("User", foreign_keys=[root_user_id])
     members= relationship("User", secondary=organization_members, back_populates="organizations")
@@ -101,6 +111,7 @@ class OrganizationKeys(Base):
     id = Column(Integer, primary_key=True)
     organization_id = Column(Integer, ForeignKey('organizations.id'), unique=True, nullable=False)
     whatsapp_business_token = Column(String(255), unique=True)
+    phone_number_id = Column(String(50), unique=True, nullable=True)  # WhatsApp business number the token sends from
 
     # Relationship
     organization = relationship("Organization", back_populates="organization_keys")
@@ -115,8 +126,8 @@ class Product(Base):
     __tablename__= 'products'
 
     id= Column(Integer, primary_key=True)
-    org_id= Column(Integer, ForeignKey('organizations.id'), nullable=False)
-    user_id= Column(Integer, ForeignKey('users.id'), nullable=False)
+    org_id= Column(Integer, ForeignKey('organizations.id'), nullable=False, index=True)
+    user_id= Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
     title= Column(String(255), nullable=False)
     description= Column(Text)
     image= Column(String(255))
@@ -171,6 +182,10 @@ class OrganizationInvite(Base):
     
     organization = relationship("Organization", back_populates="invites")
 
+    __table_args__ = (
+        Index('ix_organization_invites_org_email', 'organization_id', 'email'),
+    )
+
 class Contact(Base):
     __tablename__ = 'contacts'
 
@@ -182,6 +197,7 @@ class Contact(Base):
     name = Column(String(255), nullable=False)
     avatar = Column(String(255))  # Store image URL/path
     phone_number = Column(String(20), unique=True)
+    phone_e164 = Column(String(20), nullable=True)  # Normalized phone_number, used to match WhatsApp senders
     industry = Column(String(100), nullable=True)
     is_favorite = Column(Boolean, default=False)
     thread_id = Column(String(100), unique=True, nullable=True)
@@ -193,6 +209,50 @@ class Contact(Base):
     tags = relationship("Tag", secondary=contact_tags, back_populates="contacts")
     groups = relationship("Group", secondary=contact_groups, back_populates="contacts")
     prompts = relationship("Prompt", back_populates="contact")
+    qualification = relationship("LeadQualification", back_populates="contact", uselist=False)
+    summary = relationship("ConversationSummary", back_populates="contact", uselist=False)
+
+    __table_args__ = (
+        Index('ix_contacts_org_phone', 'org_id', 'phone_e164'),
+        Index('ix_contacts_phone_e164', 'phone_e164'),  # Sender lookups when no tenant is registered for the number
+    )
+
+    @validates('phone_number')
+    def normalize_phone_number(self, key, value):
+        self.phone_e164 = normalize_phone(value)
+        return value
+
+class LeadQualification(Base):
+    __tablename__ = 'lead_qualifications'
+
+    id = Column(Integer, primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contacts.id'), unique=True, nullable=False)
+    budget_confirmed = Column(Boolean, default=False)
+    authority_confirmed = Column(Boolean, default=False)
+    need_confirmed = Column(Boolean, default=False)
+    timeline_confirmed = Column(Boolean, default=False)
+    qualification_score = Column(Integer, default=0)
+    meeting_readiness = Column(Boolean, default=False)
+    detected_type = Column(String(10), nullable=True)  # "B2B", "B2C", or None
+    last_prompt_id = Column(Integer, ForeignKey('prompts.id'), nullable=True)  # Last prompt fed to the classifier
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    # Relationship
+    contact = relationship("Contact", back_populates="qualification")
+
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+
+    id = Column(Integer, primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contacts.id'), unique=True, nullable=False)
+    summary = Column(Text, nullable=True)
+    summarized_until_prompt_id = Column(Integer, ForeignKey('prompts.id'), nullable=True)  # Last prompt folded into the summary
+    turns_summarized = Column(Integer, default=0)
+    compactions = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    # Relationship
+    contact = relationship("Contact", back_populates="summary")
 
 class Tag(Base):
     __tablename__= 'tags'
@@ -229,6 +289,95 @@ class Prompt(Base):
     organization = relationship("Organization")
     contact = relationship("Contact", back_populates="prompts")
 
+    __table_args__ = (
+        Index('ix_prompts_contact', 'contact_id', 'id'),  # A contact's history, newest first
+        Index('ix_prompts_org_contact', 'organization_id', 'contact_id', 'id'),  # Keyset scans of an org's conversations
+    )
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON encoded handler arguments
+    group_key = Column(String(100), nullable=True, index=True)  # Jobs sharing a key never run concurrently
+    status = Column(String(20), default="queued", nullable=False, index=True)  # queued, running, done, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    available_at = Column(DateTime, default=datetime.now, nullable=False)
+    locked_until = Column(DateTime, nullable=True)  # Visibility timeout of a claimed job
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+class OutboundMessage(Base):
+    __tablename__ = 'outbound_messages'
+
+    id = Column(Integer, primary_key=True)
+    organization_id = Column(Integer, ForeignKey('organizations.id'), nullable=False)
+    contact_id = Column(Integer, ForeignKey('contacts.id'), nullable=True)
+    prompt_id = Column(Integer, ForeignKey('prompts.id'), nullable=True)  # Prompt whose response this message carries
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=True, index=True)
+    priority = Column(Integer, default=0, nullable=False)  # Lower goes first: replies 0, broadcasts 1
+    phone_number_id = Column(String(50), nullable=False)  # Sending WhatsApp business number
+    to_phone = Column(String(20), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON body for the Graph API messages endpoint
+    status = Column(String(20), default="queued", nullable=False, index=True)  # queued, sending, sent, delivered, read, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime, default=datetime.now, nullable=False)
+    locked_until = Column(DateTime, nullable=True)
+    wa_message_id = Column(String(100), nullable=True, index=True)  # Message id returned by Meta
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    read_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbound_messages_recipient', 'phone_number_id', 'to_phone', 'id'),  # Earlier unsent message to the same recipient
+        Index('ix_outbound_messages_claim', 'status', 'priority', 'id'),  # Claim order of due messages
+    )
+
+class Campaign(Base):
+    __tablename__ = 'campaigns'
+
+    id = Column(Integer, primary_key=True)
+    organization_id = Column(Integer, ForeignKey('organizations.id'), nullable=False)
+    group_id = Column(Integer, ForeignKey('groups.id'), nullable=False)
+    name = Column(String(255), nullable=False)
+    message = Column(Text, nullable=True)  # Text body, or the caption of the image
+    media_url = Column(String(500), nullable=True)
+    media_id = Column(String(100), nullable=True)  # Meta media id of media_url, uploaded once
+    status = Column(String(20), default="pending", nullable=False)  # pending, running, done
+    last_contact_id = Column(Integer, default=0, nullable=False)  # Checkpoint: members up to here are queued
+    queued = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)  # When the last member was queued
+
+class ProcessedMessage(Base):
+    __tablename__ = 'processed_messages'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String(100), unique=True, nullable=False)  # WhatsApp message id already queued for a reply
+    created_at = Column(DateTime, default=datetime.now, index=True)
+    posted_at = Column(DateTime, nullable=True)  # When the message was posted to the contact's OpenAI thread
+    reply_text = Column(Text, nullable=True)  # Reply generated for the message, reused if storing or queueing it fails
+
+class RescoreRun(Base):
+    __tablename__ = 'rescore_runs'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), unique=True, nullable=False)
+    org_id = Column(Integer, ForeignKey('organizations.id'), nullable=False)
+    last_contact_id = Column(Integer, default=0, nullable=False)  # Checkpoint: every contact up to here is re-scored
+    contacts_scored = Column(Integer, default=0)
+    prompts_scored = Column(Integer, default=0)
+    failures = Column(Integer, default=0)
+    status = Column(String(20), default="running")  # running, done
+    started_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
 """
 class Template(Base):
     __tablename__ = 'templates'
@@ -0,0 +1,106 @@
+"""
+Query-plan regression check for the hot queries.
+
+Runs EXPLAIN QUERY PLAN for each query below and fails if the plan no
+longer searches the expected index, e.g. after an index was dropped or a
+query was reshaped so the planner falls back to a table scan.
+
+    python -m db.query_plans   # exits 1 if any hot query regressed
+"""
+from sqlalchemy import select, text, or_, and_
+from sqlalchemy.engine import Engine
+from db.models import (
+    engine, Contact, Prompt, Product, Organization, OrganizationInvite, OutboundMessage, Job,
+    contact_groups, contact_tags, organization_members
+)
+from typing import List, Optional
+import sys
+
+# (name, statement, index the plan must use; None accepts any index, e.g. the implicit one of a UNIQUE column)
+HOT_QUERIES = [
+    ("sender lookup", select(Contact.id).where(Contact.org_id == 1, Contact.phone_e164.in_(["+15550000000"])),
+     "ix_contacts_org_phone"),
+    # Senders to a number without a registered tenant are matched across organizations
+    ("sender lookup, single tenant", select(Contact.id).where(Contact.phone_e164.in_(["+15550000000"])),
+     "ix_contacts_phone_e164"),
+    ("org contacts", select(Contact.id, Contact.name).where(Contact.org_id == 1), "ix_contacts_org_phone"),
+    ("contact by phone", select(Contact.id).where(Contact.org_id == 1, Contact.phone_number == "+15550000000"), None),
+    ("prompt history", select(Prompt.id, Prompt.input_text).where(Prompt.contact_id == 1, Prompt.id > 0)
+     .order_by(Prompt.id.desc()).limit(20), "ix_prompts_contact"),
+    ("rescore keyset", select(Prompt.contact_id, Prompt.id).where(
+        Prompt.organization_id == 1,
+        Prompt.contact_id.isnot(None),
+        or_(Prompt.contact_id > 1, and_(Prompt.contact_id == 1, Prompt.id > 1))
+    ).order_by(Prompt.contact_id, Prompt.id).limit(500), "ix_prompts_org_contact"),
+    ("org products", select(Product.id).where(Product.org_id == 1), "ix_products_org_id"),
+    ("user products", select(Product.id).where(Product.user_id == 1), "ix_products_user_id"),
+    ("org of root user", select(Organization.id).where(Organization.root_user_id == 1), None),
+    ("pending invite", select(OrganizationInvite.id).where(
+        OrganizationInvite.organization_id == 1, OrganizationInvite.email == "a@example.com"
+    ), "ix_organization_invites_org_email"),
+    ("group members", select(contact_groups.c.contact_id).where(contact_groups.c.group_id == 1), "ix_contact_groups_group"),
+    ("contact groups", select(contact_groups.c.group_id).where(contact_groups.c.contact_id == 1), "ix_contact_groups_contact"),
+    ("tag members", select(contact_tags.c.contact_id).where(contact_tags.c.tag_id == 1), "ix_contact_tags_tag"),
+    ("contact tags", select(contact_tags.c.tag_id).where(contact_tags.c.contact_id == 1), "ix_contact_tags_contact"),
+    ("org members", select(organization_members.c.user_id).where(organization_members.c.organization_id == 1),
+     "ix_organization_members_org"),
+    ("user orgs", select(organization_members.c.organization_id).where(organization_members.c.user_id == 1),
+     "ix_organization_members_user"),
+    ("status by message id", select(OutboundMessage.id).where(OutboundMessage.wa_message_id.in_(["wamid.1"])),
+     "ix_outbound_messages_wa_message_id"),
+    ("outbox claim order", select(OutboundMessage.id).where(OutboundMessage.status == "queued")
+     .order_by(OutboundMessage.priority, OutboundMessage.id).limit(50), "ix_outbound_messages_claim"),
+    ("outbox recipient order", select(OutboundMessage.id).where(
+        OutboundMessage.phone_number_id == "1", OutboundMessage.to_phone == "+15550000000",
+        OutboundMessage.id < 100, OutboundMessage.status.in_(["queued", "sending"])
+    ), "ix_outbound_messages_recipient"),
+    ("campaign stats", select(OutboundMessage.status).where(OutboundMessage.campaign_id == 1),
+     "ix_outbound_messages_campaign_id"),
+    ("job group", select(Job.id).where(Job.group_key == "contact:1", Job.status == "queued"), None),
+]
+
+
+def explain(bind: Engine, statement) -> List[str]:
+    sql = str(statement.compile(bind, compile_kwargs={"literal_binds": True}))
+    with bind.connect() as conn:
+        return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+
+def uses_index(plan: List[str], index: Optional[str]) -> bool:
+    """Every step searches an index, and `index` (if given) is one of them"""
+    # "SCAN ... USING COVERING INDEX" still reads the whole index, so any SCAN is a regression
+    if any(step.startswith("SCAN") for step in plan):
+        return False
+    if index is None:
+        return any("INDEX" in step or "PRIMARY KEY" in step for step in plan)
+    return any(f"INDEX {index} " in f"{step} " for step in plan)
+
+
+def check_query_plans(bind: Engine = engine) -> List[dict]:
+    """Hot queries whose plan regressed, with the plan SQLite chose"""
+    if bind.dialect.name != "sqlite":
+        return []
+    regressions = []
+    for name, statement, index in HOT_QUERIES:
+        plan = explain(bind, statement)
+        if not uses_index(plan, index):
+            regressions.append({"query": name, "expected": index or "any index", "plan": plan})
+    return regressions
+
+
+def main():
+    if engine.dialect.name != "sqlite":
+        print(f"Query-plan check only supports SQLite, not {engine.dialect.name}")
+        return
+    regressions = check_query_plans()
+    for regression in regressions:
+        print(f"REGRESSION {regression['query']}: expected {regression['expected']}")
+        for step in regression["plan"]:
+            print(f"    {step}")
+    print(f"{len(HOT_QUERIES) - len(regressions)}/{len(HOT_QUERIES)} hot queries use their index")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,53 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from utils.auth import SECRET_KEY,router as utils_router
-from routers import users, contacts, organizations, products
+from routers import users, contacts, organizations, products, campaigns
 from ai.app import router
 from wp import webhook
-from db.models import engine, Base
+from db.migrations import migrate
+from utils.jobs import job_queue, router as jobs_router
+from utils.metrics import router as metrics_router
+from ai.engine import run_registry
+from wp.graph import start_graph_client, close_graph_client
+from wp.outbox import outbox
+from wp.statuses import status_ingestor
+from wp.tenants import tenant_registry
+from utils.log import configure_logging, stop_logging
+import os
 
-app = FastAPI()
+# Seconds a shutdown waits for in-flight runs before cancelling them
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 25))
+
+
+configure_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the pooled Graph API client and start the background workers that drain queued webhook messages
+    start_graph_client()
+    await tenant_registry.refresh_async()
+    tenant_registry.start()
+    job_queue.start()
+    outbox.start()
+    status_ingestor.start()
+    yield
+    # Refuse new runs, let the current ones finish, then cancel the stragglers;
+    # their jobs go back to the queue for the next process
+    run_registry.begin_shutdown()
+    job_queue.stop_claiming()
+    if await run_registry.drain(SHUTDOWN_DRAIN_TIMEOUT):
+        run_registry.cancel_all()
+    await job_queue.stop(timeout=5)
+    await outbox.stop(timeout=10)
+    await status_ingestor.stop()
+    await tenant_registry.stop()
+    await close_graph_client()
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add SessionMiddleware
 app.add_middleware(
@@ -26,17 +66,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Bring the database schema up to the latest version
+migrate()
 
 # Include routers
 app.include_router(users.router)
 app.include_router(contacts.router)
 app.include_router(organizations.router)
 app.include_router(products.router)
+app.include_router(campaigns.router)
 app.include_router(router)
 app.include_router(webhook.router)
 app.include_router(utils_router)
+app.include_router(jobs_router)
+app.include_router(metrics_router)
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app)
\ No newline at end of file
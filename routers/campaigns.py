@@ -0,0 +1,89 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from db.models import get_db, User, Organization, Group, Campaign
+from utils.auth import get_current_user
+from schemas.campaigns_schema import CampaignModel
+from wp.broadcast import start_campaign, campaign_stats
+from fastapi.responses import JSONResponse
+
+router = APIRouter(
+    prefix="/api/campaigns"
+)
+
+
+def get_users_org(db: Session, current_user: User) -> Organization:
+    users_org = db.query(Organization).filter(Organization.root_user == current_user).first()
+    if not users_org:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Organization not found"
+        )
+    return users_org
+
+
+@router.post('/broadcast')
+async def create_broadcast(
+    data: CampaignModel,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    users_org = get_users_org(db, current_user)
+    group = db.query(Group).filter(Group.id == data.group_id).first()
+    if not group:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found"
+        )
+
+    campaign = Campaign(
+        organization_id=users_org.id,
+        group_id=group.id,
+        name=data.name,
+        message=data.message,
+        media_url=data.media_url,
+        status="pending",
+        last_contact_id=0,
+        queued=0
+    )
+    db.add(campaign)
+    try:
+        db.commit()
+        db.refresh(campaign)
+        start_campaign(db, campaign)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return JSONResponse(
+        {'detail': 'Campaign started', 'campaign_id': campaign.id},
+        status_code=status.HTTP_202_ACCEPTED
+    )
+
+
+@router.get('/')
+async def list_campaigns(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    users_org = get_users_org(db, current_user)
+    campaigns = db.query(Campaign).filter(Campaign.organization_id == users_org.id).order_by(Campaign.id.desc()).all()
+    return [campaign_stats(db, campaign) for campaign in campaigns]
+
+
+@router.get('/{campaign_id}')
+async def get_campaign(
+    campaign_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    users_org = get_users_org(db, current_user)
+    campaign = db.query(Campaign).filter(
+        Campaign.id == campaign_id,
+        Campaign.organization_id == users_org.id
+    ).first()
+    if not campaign:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Campaign not found"
+        )
+    return campaign_stats(db, campaign)
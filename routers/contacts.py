@@ -11,6 +11,8 @@ from schemas.contacts_schema import (
 from fastapi.responses import JSONResponse
 from openai import OpenAI
 from dotenv import load_dotenv
+from utils.metrics import track
+from wp.contact_cache import invalidate_contact
 
 load_dotenv()
 client= OpenAI()
@@ -62,14 +64,15 @@ async def create_contact(
     # Update thread with organization settings
     if data.thread_id:
         try:
-            client.beta.threads.update(
-                thread_id=data.thread_id,
-                tool_resources={
-                    "file_search": {
-                        "vector_store_ids": [users_org.vspace_id]
+            with track("threads.update", users_org.id):
+                client.beta.threads.update(
+                    thread_id=data.thread_id,
+                    tool_resources={
+                        "file_search": {
+                            "vector_store_ids": [users_org.vspace_id]
+                        }
                     }
-                }
-            )
+                )
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -97,6 +100,8 @@ async def create_contact(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    # The number may be cached as an unknown sender
+    invalidate_contact(new_contact.phone_number, new_contact.org_id)
     
     return JSONResponse(
         {'detail': 'Contact created successfully'},
@@ -143,6 +148,7 @@ async def update_contact(
         )
     
     # Update only provided fields
+    previous_phone = contact.phone_number
     for field, value in data.dict(exclude_unset=True).items():
         setattr(contact, field, value)
     
@@ -152,6 +158,8 @@ async def update_contact(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    invalidate_contact(previous_phone, contact.org_id)
+    invalidate_contact(contact.phone_number, contact.org_id)
     
     return JSONResponse(
         {'detail': 'Contact updated successfully'},
@@ -176,12 +184,14 @@ async def delete_contact(
             detail="Contact not found or access denied"
         )
     
+    phone_number, org_id = contact.phone_number, contact.org_id
     db.delete(contact)
     try:
         db.commit()
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    invalidate_contact(phone_number, org_id)
     
     return JSONResponse(
         {'detail': 'Contact deleted successfully'},
@@ -1,8 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException,status
 from sqlalchemy.orm import Session
 from db.models import get_db,User,Organization,OrganizationInvite, OrganizationKeys, OrganizationFileSystem
-from utils.auth import get_current_user
-from schemas.organizations_schema import OrganizationCreateModel, OrganizationUpdateModel, OrganizationInviteCreateModel, OrganizationFileSystemUpdate
+from utils.auth import get_current_user, invalidate_organization_products
+from schemas.organizations_schema import OrganizationCreateModel, OrganizationUpdateModel, OrganizationInviteCreateModel, OrganizationFileSystemUpdate, OrganizationKeysUpdate
+from wp.tenants import tenant_registry
 from fastapi.responses import JSONResponse
 
 router= APIRouter(
@@ -148,6 +149,7 @@ async def update_organization_filesystem(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    invalidate_organization_products(users_org.id)
 
     return JSONResponse(
         {"detail": "Organization filesystem updated successfully"},
@@ -155,6 +157,54 @@ async def update_organization_filesystem(
     )
 
 
+@router.patch('/keys')
+async def update_organization_keys(
+    data: OrganizationKeysUpdate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    # Get user's organization
+    users_org = db.query(Organization).filter(Organization.root_user == current_user).first()
+    if not users_org:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Organization not found"
+        )
+
+    # Verify user has permission (is root user)
+    if users_org.root_user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only organization owner can update WhatsApp keys"
+        )
+
+    org_keys = db.query(OrganizationKeys).filter(OrganizationKeys.organization_id == users_org.id).first()
+    if not org_keys:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Organization keys not found"
+        )
+
+    # Update fields if provided in request
+    if data.whatsapp_business_token is not None:
+        org_keys.whatsapp_business_token = data.whatsapp_business_token
+    if data.phone_number_id is not None:
+        org_keys.phone_number_id = data.phone_number_id
+
+    try:
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    # Route this process's messages with the new keys right away
+    await tenant_registry.refresh_async()
+
+    return JSONResponse(
+        {"detail": "Organization keys updated successfully"},
+        status_code=status.HTTP_200_OK
+    )
+
+
 @router.patch('/update')
 async def update_org(data: OrganizationUpdateModel,  db: Session= Depends(get_db), current_user: User= Depends(get_current_user)):
     organization= db.query(Organization).filter(Organization.root_user == current_user).first()
@@ -167,6 +217,11 @@ async def update_org(data: OrganizationUpdateModel,  db: Session= Depends(get_db
     organization.industry_type = data.industry_type if data.industry_type else organization.industry_type
     organization.meeting_url = data.meeting_url if data.meeting_url else organization.meeting_url
     organization.root_user = data.root_user if data.root_user else organization.root_user
+    if data.classifier_low_threshold is not None:
+        organization.classifier_low_threshold = data.classifier_low_threshold
+    if data.classifier_high_threshold is not None:
+        organization.classifier_high_threshold = data.classifier_high_threshold
+    organization.conversation_engine = data.conversation_engine if data.conversation_engine else organization.conversation_engine
 
     try:
         db.commit()
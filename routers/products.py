@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from db.models import get_db, User, Product, Category, Organization, organization_members
-from utils.auth import get_current_user
+from utils.auth import get_current_user, invalidate_organization_products
 from fastapi.responses import JSONResponse
 from schemas.products_schema import CategoryModel, ProductModel
 import requests
@@ -76,6 +76,7 @@ async def create_product(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    invalidate_organization_products(organization.id)
         
     return JSONResponse({'detail': "New Product Registered"}, status_code=status.HTTP_201_CREATED)
 
@@ -126,6 +127,7 @@ async def update_product(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
+    invalidate_organization_products(product.org_id)
     
     return JSONResponse(
         {"detail": "Product updated successfully"},
@@ -138,7 +140,9 @@ async def update_product(
 async def delete_product(product_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     product= db.query(Product).filter(Product.id == product_id).first()
     if product:
+        org_id = product.org_id
         db.delete(product)
         db.commit()
+        invalidate_organization_products(org_id)
         return JSONResponse({"detail":"Product Deleted Successfully"}, status_code=status.HTTP_204_NO_CONTENT)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
@@ -0,0 +1,14 @@
+from pydantic import BaseModel, model_validator
+from typing import Optional
+
+class CampaignModel(BaseModel):
+    group_id: int
+    name: str
+    message: Optional[str] = None
+    media_url: Optional[str] = None  # Image sent with `message` as its caption
+
+    @model_validator(mode="after")
+    def check_content(self):
+        if not self.message and not self.media_url:
+            raise ValueError("A campaign needs a message or a media_url")
+        return self
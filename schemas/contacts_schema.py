@@ -7,6 +7,7 @@ from fastapi import Depends
 from db.models import get_db
 from db.models import Organization
 from dotenv import load_dotenv
+from utils.metrics import track
 
 load_dotenv()
 client= OpenAI()
@@ -27,7 +28,8 @@ class ContactModel(BaseModel):
     @model_validator(mode='before')
     def populate_thread_id(cls, values):
         if not values.get('thread_id'):
-            thread = client.beta.threads.create()
+            with track("threads.create", values.get('org_id')):
+                thread = client.beta.threads.create()
             values['thread_id'] = thread.id
         return values
 
@@ -1,9 +1,11 @@
 from pydantic import BaseModel,EmailStr, model_validator, Field
 from openai import OpenAI
+from utils.metrics import track
 import random
 client= OpenAI()
 
-def create_assistant_organization(name, business_model):
+def build_assistant_instructions(business_model):
+    """Instructions for the organization's sales assistant, by business model"""
     base_context= ""
     if business_model == "B2B":
         base_context= base_context + f"""
@@ -61,18 +63,23 @@ def create_assistant_organization(name, business_model):
         2. Adjust communication style accordingly
         3. Follow appropriate qualification process
         """
-    assistant= client.beta.assistants.create(
-        name=name,
-        model="gpt-4o",
-        instructions=base_context,
-        tools=[{"type": "file_search"}],
-    )
+    return base_context
+
+def create_assistant_organization(name, business_model):
+    with track("assistants.create"):
+        assistant= client.beta.assistants.create(
+            name=name,
+            model="gpt-4o",
+            instructions=build_assistant_instructions(business_model),
+            tools=[{"type": "file_search"}],
+        )
     return assistant.id
 
 def create_vspace_organization(name):
-    vector_store = client.beta.vector_stores.create(
-    name=name,
-    )
+    with track("vector_stores.create"):
+        vector_store = client.beta.vector_stores.create(
+        name=name,
+        )
     return (vector_store.id)
 
 
@@ -107,6 +114,16 @@ class OrganizationUpdateModel(BaseModel):
       business_model: str= None
       meeting_url: str= None
       root_user: int= None
+      classifier_low_threshold: float= Field(None, ge=0, le=1)
+      classifier_high_threshold: float= Field(None, ge=0, le=1)
+      conversation_engine: str = Field(None, pattern="^(assistants|completions)$")
+
+      @model_validator(mode="after")
+      def check_thresholds(self):
+          if (self.classifier_low_threshold is not None and self.classifier_high_threshold is not None
+                  and self.classifier_low_threshold >= self.classifier_high_threshold):
+              raise ValueError("classifier_low_threshold must be below classifier_high_threshold")
+          return self
 
 
 class OrganizationInviteCreateModel(BaseModel):
@@ -119,6 +136,12 @@ class OrganizationInviteCreateModel(BaseModel):
 class OrganizationKeysModel(BaseModel):
     organization_id: int
     whatsapp_business_token: str = None
+    phone_number_id: str = None
+
+
+class OrganizationKeysUpdate(BaseModel):
+    whatsapp_business_token: str= None
+    phone_number_id: str= None
 
 
 class OrganizationFileSystemUpdate(BaseModel):
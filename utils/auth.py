@@ -31,9 +31,17 @@ def end_session(request: Request):
     request.session.clear()
 
 from sqlalchemy.orm import Session
-from db.models import get_db, Product,OrganizationFileSystem
+from db.models import get_db, SessionLocal, Product,OrganizationFileSystem
 from fastapi import APIRouter,Depends
+from utils.cache import TTLCache
+from utils.metrics import metrics
+from utils.log import get_logger
 import requests
+import threading
+import time
+import os
+
+logger = get_logger(__name__)
 
 router= APIRouter(
     prefix="/api/helper"
@@ -55,4 +63,84 @@ def get_organization_products(org_id: int, db: Session = Depends(get_db)):
         datt= []
         datt.append(org_products)
         datt.append(data)
-    return datt
\ No newline at end of file
+    return datt
+
+
+# Serialized product catalogs per organization, used by the assistant tool.
+# Entries are fresh for PRODUCT_CACHE_TTL seconds and may be served stale
+# (while a background refresh runs) until PRODUCT_CACHE_STALE_TTL.
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", 60))
+PRODUCT_CACHE_STALE_TTL = float(os.getenv("PRODUCT_CACHE_STALE_TTL", 600))
+product_catalog_cache = TTLCache(maxsize=int(os.getenv("PRODUCT_CACHE_SIZE", 1000)), ttl=PRODUCT_CACHE_STALE_TTL)
+metrics.register_collector("product_catalog_cache", product_catalog_cache.stats)
+_catalog_generation = {}
+_catalog_refreshing = set()
+_catalog_lock = threading.Lock()
+
+
+def load_organization_catalog(org_id: int) -> list:
+    """Query the org's products and external catalog in a JSON-serializable shape"""
+    db = SessionLocal()
+    try:
+        org_products= db.query(Product).filter(Product.org_id == org_id).all()
+        my_org_keys= db.query(OrganizationFileSystem).filter(OrganizationFileSystem.org_id == org_id).first()
+        products = [{"id": p.id, "title": p.title, "description": p.description,
+                     "price": p.price_per_quantity, "currency": p.currency}
+                    for p in org_products]
+        api = my_org_keys.api if my_org_keys else None
+        api_key = my_org_keys.api_key if my_org_keys else None
+    finally:
+        db.close()
+
+    external_data = None
+    if api:
+        headers= {"Authorization": f"Bearer {api_key}"} if api_key else None
+        response= requests.get(api, headers=headers, timeout=10)
+        if response.status_code == 200:
+            external_data = response.json()
+
+    return [{"products": products, "external_data": external_data}]
+
+
+def _store_catalog(org_id: int, generation: int, catalog: list):
+    with _catalog_lock:
+        # Drop results that raced with an invalidation
+        if _catalog_generation.get(org_id, 0) == generation:
+            product_catalog_cache.set(org_id, (catalog, time.monotonic()))
+
+
+def _refresh_catalog(org_id: int, generation: int):
+    try:
+        _store_catalog(org_id, generation, load_organization_catalog(org_id))
+    except Exception as e:
+        logger.warning("Product catalog refresh failed", extra={"org_id": org_id, "error": str(e)})
+    finally:
+        with _catalog_lock:
+            _catalog_refreshing.discard(org_id)
+
+
+def get_cached_organization_products(org_id: int) -> list:
+    """Return the org's product catalog from cache, revalidating stale entries in the background"""
+    with _catalog_lock:
+        generation = _catalog_generation.get(org_id, 0)
+    cached = product_catalog_cache.get(org_id)
+    if cached is None:
+        catalog = load_organization_catalog(org_id)
+        _store_catalog(org_id, generation, catalog)
+        return catalog
+
+    catalog, fetched_at = cached
+    if time.monotonic() - fetched_at > PRODUCT_CACHE_TTL:
+        with _catalog_lock:
+            start_refresh = org_id not in _catalog_refreshing
+            _catalog_refreshing.add(org_id)
+        if start_refresh:
+            threading.Thread(target=_refresh_catalog, args=(org_id, generation), daemon=True).start()
+    return catalog
+
+
+def invalidate_organization_products(org_id: int):
+    """Drop the cached catalog after products or filesystem settings change"""
+    with _catalog_lock:
+        _catalog_generation[org_id] = _catalog_generation.get(org_id, 0) + 1
+        product_catalog_cache.invalidate(org_id)
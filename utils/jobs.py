@@ -0,0 +1,355 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import or_, and_, func, exists
+from sqlalchemy.orm import Session, aliased
+from db.models import SessionLocal, Job, User
+from utils.auth import get_current_user
+from utils.metrics import metrics
+from utils.log import get_logger
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+from collections import Counter
+import asyncio
+import random
+import json
+import os
+
+logger = get_logger(__name__)
+
+router = APIRouter(
+    prefix="/api/jobs"
+)
+
+
+class RetryLater(Exception):
+    """Raised by a handler to put its job back in the queue without using up an attempt"""
+
+
+class JobQueue:
+    """
+    Durable job queue stored in the `jobs` table, drained by a pool of asyncio workers.
+
+    A claimed job is hidden from other workers until its visibility timeout
+    passes, so jobs held by a crashed worker or process are picked up again.
+    Handlers are cancelled and retried once they run for `handler_timeout`,
+    which stays below the visibility timeout.
+    Failed jobs are retried with jittered exponential backoff until they run
+    out of attempts.
+
+    A handler raising RetryLater, or cancelled during shutdown, hands its jobs
+    back to the queue immediately without counting the attempt.
+
+    Jobs with the same `group_key` are never claimed while another job of that
+    group is running. Handlers registered with `coalesce=True` receive every
+    queued job of the claimed job's group as one batch of payloads.
+    """
+
+    def __init__(self, workers: int = 4, visibility_timeout: float = 300, poll_interval: float = 1.0, max_attempts: int = 5, handler_timeout: Optional[float] = None):
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        # A handler is cut off before its lease runs out, so no other worker can claim the job while it still runs
+        self.handler_timeout = handler_timeout or visibility_timeout - max(10, visibility_timeout * 0.1)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.handlers: Dict[str, Callable[[Any], Awaitable[Any]]] = {}
+        self.coalesced_kinds = set()
+        self.counters = Counter()
+        self._tasks = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    def handler(self, kind: str, coalesce: bool = False):
+        """Register the coroutine that processes jobs of `kind` (a list of payloads if `coalesce`)"""
+        def decorator(func):
+            self.handlers[kind] = func
+            if coalesce:
+                self.coalesced_kinds.add(kind)
+            return func
+        return decorator
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], db: Session = None, group_key: str = None, delay: float = 0, unique: bool = False) -> Optional[int]:
+        """Queue a job; with `unique`, skip it if one of the same kind and group is already pending"""
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            if unique and db.query(Job.id).filter(
+                Job.kind == kind,
+                Job.group_key == group_key,
+                Job.status.in_(("queued", "running"))
+            ).first() is not None:
+                return None
+            job = Job(
+                kind=kind,
+                payload=json.dumps(payload),
+                group_key=group_key,
+                status="queued",
+                attempts=0,
+                max_attempts=self.max_attempts,
+                available_at=datetime.now() + timedelta(seconds=delay)
+            )
+            db.add(job)
+            db.commit()
+            job_id = job.id
+        finally:
+            if own_session:
+                db.close()
+        self.counters["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def enqueue_many(self, kind: str, jobs: list, db: Session, delay: float = 0) -> int:
+        """Queue several (payload, group_key) jobs of one kind in a single transaction"""
+        available_at = datetime.now() + timedelta(seconds=delay)
+        db.add_all([
+            Job(
+                kind=kind,
+                payload=json.dumps(payload),
+                group_key=group_key,
+                status="queued",
+                attempts=0,
+                max_attempts=self.max_attempts,
+                available_at=available_at
+            )
+            for payload, group_key in jobs
+        ])
+        db.commit()
+        self.counters["enqueued"] += len(jobs)
+        if jobs and self._wakeup is not None:
+            self._wakeup.set()
+        return len(jobs)
+
+    @staticmethod
+    def _claimable(now: datetime):
+        running = aliased(Job)
+        group_busy = exists().where(
+            running.group_key == Job.group_key,
+            running.id != Job.id,
+            running.status == "running",
+            running.locked_until >= now
+        )
+        return and_(
+            or_(
+                and_(Job.status == "queued", Job.available_at <= now),
+                and_(Job.status == "running", Job.locked_until < now)
+            ),
+            ~group_busy
+        )
+
+    def _claim(self) -> Optional[tuple]:
+        """
+        Atomically take the oldest available job; safe across workers and processes.
+        Returns (kind, [(job_id, payload, attempts), ...]) with the claimed job first.
+        """
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            locked_until = now + timedelta(seconds=self.visibility_timeout)
+            candidates = db.query(Job.id).filter(self._claimable(now)).order_by(Job.id).limit(self.workers).all()
+            for (job_id,) in candidates:
+                claimed = db.query(Job).filter(Job.id == job_id, self._claimable(now)).update({
+                    Job.status: "running",
+                    Job.locked_until: locked_until,
+                    Job.attempts: Job.attempts + 1
+                }, synchronize_session=False)
+                db.commit()
+                if not claimed:
+                    continue
+                job = db.get(Job, job_id)
+                if job.attempts > job.max_attempts:
+                    # The job kept timing out (e.g. its worker died); stop retrying it
+                    job.status = "failed"
+                    job.finished_at = now
+                    job.last_error = job.last_error or "Visibility timeout exceeded"
+                    db.commit()
+                    self.counters["failed"] += 1
+                    continue
+
+                batch = [(job.id, json.loads(job.payload), job.attempts)]
+                if job.kind in self.coalesced_kinds and job.group_key is not None:
+                    batch += self._absorb_group(db, job, locked_until)
+                return job.kind, batch
+            return None
+        finally:
+            db.close()
+
+    def _absorb_group(self, db: Session, job: Job, locked_until: datetime) -> list:
+        """Claim the other queued jobs of `job`'s group, including ones not yet due"""
+        pending = [job_id for (job_id,) in db.query(Job.id).filter(
+            Job.kind == job.kind,
+            Job.group_key == job.group_key,
+            Job.status == "queued",
+            Job.id != job.id
+        ).order_by(Job.id).all()]
+        if not pending:
+            return []
+        db.query(Job).filter(Job.id.in_(pending), Job.status == "queued").update({
+            Job.status: "running",
+            Job.locked_until: locked_until,
+            Job.attempts: Job.attempts + 1
+        }, synchronize_session=False)
+        db.commit()
+        absorbed = db.query(Job).filter(
+            Job.id.in_(pending),
+            Job.status == "running",
+            Job.locked_until == locked_until
+        ).order_by(Job.id).all()
+        self.counters["coalesced"] += len(absorbed)
+        return [(other.id, json.loads(other.payload), other.attempts) for other in absorbed]
+
+    def _complete(self, job_ids: list):
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id.in_(job_ids)).update({
+                Job.status: "done",
+                Job.locked_until: None,
+                Job.finished_at: datetime.now()
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        self.counters["completed"] += len(job_ids)
+
+    def _fail(self, job_id: int, attempts: int, error: str):
+        now = datetime.now()
+        values = {Job.last_error: error[:2000], Job.locked_until: None}
+        if attempts >= self.max_attempts:
+            values.update({Job.status: "failed", Job.finished_at: now})
+            self.counters["failed"] += 1
+        else:
+            delay = min(300, 2 ** attempts) * random.uniform(0.5, 1.5)
+            values.update({Job.status: "queued", Job.available_at: now + timedelta(seconds=delay)})
+            self.counters["retried"] += 1
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id == job_id).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _requeue(self, job_ids: list):
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id.in_(job_ids)).update({
+                Job.status: "queued",
+                Job.available_at: datetime.now(),
+                Job.locked_until: None,
+                Job.attempts: Job.attempts - 1
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        self.counters["requeued"] += len(job_ids)
+
+    async def _run(self, kind: str, batch: list):
+        """Run a claimed batch through its handler and record the outcome"""
+        handler = self.handlers.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{kind}'")
+            if kind in self.coalesced_kinds:
+                await asyncio.wait_for(handler([payload for _, payload, _ in batch]), self.handler_timeout)
+            else:
+                await asyncio.wait_for(handler(batch[0][1]), self.handler_timeout)
+        except RetryLater as e:
+            logger.info("Job handed back", extra={"job_id": batch[0][0], "kind": kind, "reason": str(e)})
+            await asyncio.to_thread(self._requeue, [job_id for job_id, _, _ in batch])
+        except asyncio.CancelledError:
+            # Shutdown ran out of patience; another worker or process picks the jobs up
+            try:
+                await asyncio.to_thread(self._requeue, [job_id for job_id, _, _ in batch])
+            except Exception as e:
+                logger.error("Could not requeue cancelled jobs", extra={"job_id": batch[0][0], "kind": kind, "error": str(e)})
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning("Job failed", extra={"job_id": batch[0][0], "kind": kind, "attempt": batch[0][2], "error": error})
+            for job_id, _, attempts in batch:
+                await asyncio.to_thread(self._fail, job_id, attempts, error)
+        else:
+            await asyncio.to_thread(self._complete, [job_id for job_id, _, _ in batch])
+
+    async def _worker(self):
+        while self._running:
+            try:
+                claimed = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                # E.g. "database is locked" under write load; the next poll tries again
+                logger.error("Could not claim a job", extra={"error": str(e)})
+                self.counters["claim_errors"] += 1
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if claimed is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            kind, batch = claimed
+            try:
+                await self._run(kind, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The outcome was not stored; the jobs run again once their visibility timeout passes
+                logger.error("Could not record job outcome", extra={"job_id": batch[0][0], "kind": kind, "error": str(e)})
+                self.counters["bookkeeping_errors"] += 1
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop_claiming(self):
+        self._running = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Stop claiming new jobs and let in-flight ones finish; after `timeout` seconds cancel and requeue them"""
+        self.stop_claiming()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        db = SessionLocal()
+        try:
+            depth = dict(db.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+            oldest = db.query(func.min(Job.created_at)).filter(Job.status == "queued").scalar()
+        finally:
+            db.close()
+        return {
+            "depth": depth,
+            "oldest_queued_seconds": round((datetime.now() - oldest).total_seconds(), 1) if oldest else 0,
+            "workers": len(self._tasks),
+            "counters": dict(self.counters)
+        }
+
+
+job_queue = JobQueue(
+    workers=int(os.getenv("JOB_WORKERS", 4)),
+    visibility_timeout=float(os.getenv("JOB_VISIBILITY_TIMEOUT", 300)),
+    poll_interval=float(os.getenv("JOB_POLL_INTERVAL", 1.0)),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", 5)),
+    handler_timeout=float(os.getenv("JOB_HANDLER_TIMEOUT", 0)) or None
+)
+
+
+@router.get('/stats')
+async def job_queue_stats(current_user: User = Depends(get_current_user)):
+    return await asyncio.to_thread(job_queue.stats)
+
+
+async def _collect_job_stats():
+    return await asyncio.to_thread(job_queue.stats)
+
+metrics.register_collector("jobs", _collect_job_stats)
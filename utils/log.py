@@ -0,0 +1,81 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import logging
+import orjson
+import queue
+import random
+import sys
+import os
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of DEBUG/INFO records that are kept; warnings and errors are never sampled
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+
+# Attributes every LogRecord has; anything else was passed through `extra` and becomes a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and the `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging():
+    """
+    Route the app's logs through a queue so callers never wait on stdout;
+    a background thread formats and writes them. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [handler]
+    # Per-request lines from the HTTP clients would drown the app's own logs
+    for name in ("httpx", "httpcore", "openai"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Flush the queued records; called on shutdown"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
@@ -0,0 +1,152 @@
+from fastapi import APIRouter, Header, HTTPException, status
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, Optional
+import bisect
+import hmac
+import inspect
+import threading
+import time
+import os
+
+router = APIRouter(
+    prefix="/internal"
+)
+
+# Shared secret scrapers send in X-Metrics-Token; the endpoint stays closed while it is unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram in milliseconds"""
+
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 1)
+        return round(self.max, 1)
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total, 1),
+            "avg_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "max_ms": round(self.max, 1),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {str(bound): count for bound, count in zip(self.BUCKETS_MS, self.counts) if count}
+        }
+
+
+class MetricsRegistry:
+    """Histograms and counters labelled by metric name, organization and operation"""
+
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = Counter()
+        self.collectors: Dict[str, Callable[[], Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, org_id: Optional[int] = None, operation: str = ""):
+        with self._lock:
+            self.histograms[(name, org_id, operation)].observe(value)
+
+    def inc(self, name: str, value: float = 1, org_id: Optional[int] = None, operation: str = ""):
+        with self._lock:
+            self.counters[(name, org_id, operation)] += value
+
+    def register_collector(self, name: str, collector: Callable[[], Any]):
+        """Expose another component's stats (caches, queues) on the metrics endpoint; may be async"""
+        self.collectors[name] = collector
+
+    def record_usage(self, usage, org_id: Optional[int] = None, operation: str = ""):
+        """Add the token counts of an OpenAI `usage` object"""
+        if usage is None:
+            return
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            value = getattr(usage, field, None)
+            if value:
+                self.inc(f"openai_{field}", value, org_id, operation)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = [
+                {"name": name, "org_id": org_id, "operation": operation, **histogram.snapshot()}
+                for (name, org_id, operation), histogram in self.histograms.items()
+            ]
+            counters = [
+                {"name": name, "org_id": org_id, "operation": operation, "value": value}
+                for (name, org_id, operation), value in self.counters.items()
+            ]
+        return {"histograms": histograms, "counters": counters}
+
+
+metrics = MetricsRegistry()
+
+
+class track:
+    """
+    Time a block of work into the `openai_latency_ms` histogram (or `metric`),
+    counting failures in `<metric>_errors`. Works with both `with` and `async with`.
+    """
+
+    def __init__(self, operation: str, org_id: Optional[int] = None, metric: str = "openai_latency_ms"):
+        self.operation = operation
+        self.org_id = org_id
+        self.metric = metric
+
+    def usage(self, usage):
+        metrics.record_usage(usage, self.org_id, self.operation)
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        metrics.observe(self.metric, (time.perf_counter() - self.started_at) * 1000, self.org_id, self.operation)
+        if exc_type is not None:
+            metrics.inc(f"{self.metric}_errors", 1, self.org_id, self.operation)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+@router.get('/metrics')
+async def get_metrics(x_metrics_token: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Metrics endpoint is disabled, set METRICS_TOKEN")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+
+    snapshot = metrics.snapshot()
+    for name, collector in metrics.collectors.items():
+        try:
+            result = collector()
+            snapshot[name] = await result if inspect.isawaitable(result) else result
+        except Exception as e:
+            snapshot[name] = {"error": str(e)}
+    return snapshot
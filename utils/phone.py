@@ -0,0 +1,25 @@
+from typing import Optional
+import re
+import os
+
+# Country calling code (digits only) applied to national numbers such as "0301 2345678"
+DEFAULT_COUNTRY_CODE = os.getenv("DEFAULT_COUNTRY_CODE", "")
+
+
+def normalize_phone(raw: Optional[str]) -> Optional[str]:
+    """
+    Best-effort E.164 form of a phone number ("+" and 8 to 15 digits), or None.
+    WhatsApp sends sender numbers as bare international digits ("15551234567").
+    """
+    if not raw:
+        return None
+    raw = raw.strip()
+    digits = re.sub(r"\D", "", raw)
+    if raw.startswith("00"):
+        digits = digits[2:]
+    elif not raw.startswith("+") and digits.startswith("0") and DEFAULT_COUNTRY_CODE:
+        digits = DEFAULT_COUNTRY_CODE + digits.lstrip("0")
+    # Country codes never start with 0, so a leftover trunk prefix means the number is unusable
+    if digits.startswith("0") or not 8 <= len(digits) <= 15:
+        return None
+    return f"+{digits}"
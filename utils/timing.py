@@ -0,0 +1,29 @@
+from typing import Awaitable, Dict, TypeVar
+from contextlib import contextmanager
+import time
+
+T = TypeVar("T")
+
+
+class StageTimer:
+    """Collects wall-clock durations (ms) of named pipeline stages"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        """Await `awaitable` and record its duration, usable inside asyncio.gather"""
+        with self.stage(name):
+            return await awaitable
+
+    def summary(self) -> Dict[str, float]:
+        return {**self.stages, "total": round((time.perf_counter() - self.started_at) * 1000, 1)}
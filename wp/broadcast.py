@@ -0,0 +1,161 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Optional
+from db.models import SessionLocal, Campaign, Contact, OutboundMessage, contact_groups
+from wp.graph import upload_media
+from wp.outbox import outbox
+from wp.send_msg_imgs import text_message, image_message
+from wp.tenants import tenant_registry
+from utils.jobs import job_queue
+from utils.metrics import metrics
+from utils.log import get_logger
+from datetime import datetime
+import asyncio
+import os
+
+logger = get_logger(__name__)
+
+# Group members read and queued per transaction
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 500))
+# Outbox priority of broadcast messages; replies use 0 and overtake them
+BROADCAST_PRIORITY = 1
+
+
+def start_campaign(db: Session, campaign: Campaign):
+    """Queue the job that fans a campaign out to its group"""
+    job_queue.enqueue("broadcast_campaign", {"campaign_id": campaign.id}, db=db, group_key=f"campaign:{campaign.id}", unique=True)
+
+
+def campaign_stats(db: Session, campaign: Campaign) -> dict:
+    """Progress, delivery counts and send throughput of a campaign"""
+    counts = dict(db.query(OutboundMessage.status, func.count(OutboundMessage.id)).filter(
+        OutboundMessage.campaign_id == campaign.id
+    ).group_by(OutboundMessage.status).all())
+    first_sent, last_sent = db.query(func.min(OutboundMessage.sent_at), func.max(OutboundMessage.sent_at)).filter(
+        OutboundMessage.campaign_id == campaign.id
+    ).one()
+    sent = sum(counts.get(status, 0) for status in ("sent", "delivered", "read"))
+    elapsed = (last_sent - first_sent).total_seconds() if first_sent and last_sent else 0
+    return {
+        "id": campaign.id,
+        "name": campaign.name,
+        "group_id": campaign.group_id,
+        "status": campaign.status,
+        "queued": campaign.queued,
+        "sent": sent,
+        "delivered": counts.get("delivered", 0) + counts.get("read", 0),
+        "read": counts.get("read", 0),
+        "failed": counts.get("failed", 0),
+        "pending": counts.get("queued", 0) + counts.get("sending", 0),
+        "messages_per_second": round(sent / elapsed, 2) if elapsed else None,
+        "created_at": campaign.created_at.isoformat() if campaign.created_at else None,
+        "started_at": campaign.started_at.isoformat() if campaign.started_at else None,
+        "finished_at": campaign.finished_at.isoformat() if campaign.finished_at else None
+    }
+
+
+def _begin(campaign_id: int) -> Optional[dict]:
+    """Mark the campaign running; returns what the fan-out needs, or None if there is nothing to do"""
+    db = SessionLocal()
+    try:
+        campaign = db.query(Campaign).filter(Campaign.id == campaign_id).first()
+        if not campaign or campaign.status == "done":
+            return None
+        if campaign.status == "pending":
+            campaign.status = "running"
+            campaign.started_at = datetime.now()
+            db.commit()
+        return {
+            "organization_id": campaign.organization_id,
+            "media_url": campaign.media_url,
+            "media_id": campaign.media_id
+        }
+    finally:
+        db.close()
+
+
+def _save_media_id(campaign_id: int, media_id: str):
+    db = SessionLocal()
+    try:
+        db.query(Campaign).filter(Campaign.id == campaign_id).update({Campaign.media_id: media_id}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _queue_chunk(campaign_id: int, phone_number_id: str) -> int:
+    """
+    Queue the campaign's message for the next BROADCAST_CHUNK_SIZE members after its checkpoint.
+    The messages and the advanced checkpoint commit together; returns how many were queued.
+    """
+    db = SessionLocal()
+    try:
+        campaign = db.query(Campaign).filter(Campaign.id == campaign_id).one()
+        members = db.query(Contact.id, Contact.phone_number).join(
+            contact_groups, contact_groups.c.contact_id == Contact.id
+        ).filter(
+            contact_groups.c.group_id == campaign.group_id,
+            Contact.org_id == campaign.organization_id,
+            Contact.phone_number.isnot(None),
+            Contact.id > campaign.last_contact_id
+        ).distinct().order_by(Contact.id).limit(BROADCAST_CHUNK_SIZE).all()
+        if not members:
+            campaign.status = "done"
+            campaign.finished_at = datetime.now()
+            db.commit()
+            return 0
+
+        for contact_id, phone_number in members:
+            if campaign.media_id:
+                message = image_message(phone_number, media_id=campaign.media_id, caption=campaign.message)
+            else:
+                message = text_message(phone_number, campaign.message)
+            outbox.enqueue(
+                db,
+                campaign.organization_id,
+                phone_number,
+                message,
+                contact_id=contact_id,
+                phone_number_id=phone_number_id,
+                campaign_id=campaign.id,
+                priority=BROADCAST_PRIORITY
+            )
+        campaign.last_contact_id = members[-1][0]
+        campaign.queued += len(members)
+        db.commit()
+        return len(members)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@job_queue.handler("broadcast_campaign")
+async def run_campaign(payload: dict):
+    """
+    Queue a campaign's message for every member of its group, chunk by chunk.
+    Each chunk and its checkpoint commit together, so a retried job resumes
+    after the last queued member; the outbox does the paced sending. The
+    database work runs in threads so webhooks and sends keep flowing.
+    """
+    campaign_id = payload["campaign_id"]
+    campaign = await asyncio.to_thread(_begin, campaign_id)
+    if campaign is None:
+        return
+
+    tenant = tenant_registry.for_org(campaign["organization_id"])
+    if campaign["media_url"] and not campaign["media_id"]:
+        media_id = await upload_media(tenant.phone_number_id, tenant.token, campaign["media_url"], campaign["organization_id"])
+        await asyncio.to_thread(_save_media_id, campaign_id, media_id)
+
+    queued = 0
+    while True:
+        count = await asyncio.to_thread(_queue_chunk, campaign_id, tenant.phone_number_id)
+        if not count:
+            break
+        queued += count
+        outbox.wake()
+        metrics.inc("campaign_messages_queued", count, campaign["organization_id"])
+
+    logger.info("Campaign queued", extra={"campaign_id": campaign_id, "queued": queued})
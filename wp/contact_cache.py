@@ -0,0 +1,69 @@
+from sqlalchemy.orm import Session
+from db.models import Contact, Organization
+from utils.cache import TTLCache
+from utils.metrics import metrics
+from utils.phone import normalize_phone
+from typing import Dict, Iterable, Optional
+import os
+
+# Unknown senders are remembered briefly so spam does not hit the database on every message
+UNKNOWN_SENDER_TTL = float(os.getenv("CONTACT_CACHE_UNKNOWN_TTL", 60))
+_UNKNOWN = {}
+
+# (org_id, E.164 phone) -> {contact_id, org_id, thread_id, assistant_id}
+contact_cache = TTLCache(
+    maxsize=int(os.getenv("CONTACT_CACHE_SIZE", 20000)),
+    ttl=float(os.getenv("CONTACT_CACHE_TTL", 600))
+)
+metrics.register_collector("contact_cache", contact_cache.stats)
+
+
+def resolve_senders(db: Session, phones: Iterable[str], org_id: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Map WhatsApp sender numbers to their contact routing info, skipping unknown senders.
+    Cache misses are resolved together with one indexed query.
+    """
+    normalized = {phone: normalize_phone(phone) for phone in phones}
+    resolved, missing = {}, set()
+    for phone, e164 in normalized.items():
+        if e164 is None:
+            continue
+        route = contact_cache.get((org_id, e164))
+        if route is None:
+            missing.add(e164)
+        elif route is not _UNKNOWN:
+            resolved[phone] = route
+
+    if missing:
+        query = db.query(
+            Contact.id, Contact.org_id, Contact.thread_id, Contact.phone_e164, Organization.assistant_id
+        ).join(Organization, Organization.id == Contact.org_id).filter(Contact.phone_e164.in_(missing))
+        if org_id is not None:
+            query = query.filter(Contact.org_id == org_id)
+        found = {}
+        for contact_id, contact_org_id, thread_id, e164, assistant_id in query.all():
+            found[e164] = {
+                "contact_id": contact_id,
+                "org_id": contact_org_id,
+                "thread_id": thread_id,
+                "assistant_id": assistant_id
+            }
+        for e164 in missing:
+            if e164 in found:
+                contact_cache.set((org_id, e164), found[e164])
+            else:
+                contact_cache.set((org_id, e164), _UNKNOWN, ttl=UNKNOWN_SENDER_TTL)
+        for phone, e164 in normalized.items():
+            if e164 in found:
+                resolved[phone] = found[e164]
+    return resolved
+
+
+def invalidate_contact(phone_number: Optional[str], org_id: Optional[int] = None):
+    """Drop a contact's cached routing after its phone number, thread or existence changed"""
+    e164 = normalize_phone(phone_number)
+    if e164 is None:
+        return
+    contact_cache.invalidate((None, e164))
+    if org_id is not None:
+        contact_cache.invalidate((org_id, e164))
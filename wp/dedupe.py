@@ -0,0 +1,90 @@
+from sqlalchemy.orm import Session
+from db.models import ProcessedMessage
+from utils.cache import TTLCache
+from utils.metrics import metrics
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Set
+import os
+
+# Meta keeps re-delivering an unacknowledged webhook for days
+DEDUPE_RETENTION_DAYS = float(os.getenv("DEDUPE_RETENTION_DAYS", 7))
+# Delete expired rows once every this many new message ids
+DEDUPE_PRUNE_EVERY = int(os.getenv("DEDUPE_PRUNE_EVERY", 1000))
+
+
+class MessageDedupe:
+    """
+    Remembers which WhatsApp message ids were already queued.
+
+    Recent ids are answered from an in-memory LRU; everything else is checked
+    against the `processed_messages` table, which is shared by all workers and
+    survives restarts. Its unique constraint settles concurrent re-deliveries.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: float = 3600):
+        self.recent = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._since_prune = 0
+
+    def new_ids(self, db: Session, message_ids: Iterable[str]) -> Set[str]:
+        """Return the ids that have not been seen before"""
+        unknown = {message_id for message_id in message_ids if self.recent.get(message_id) is None}
+        if unknown:
+            seen = {message_id for (message_id,) in db.query(ProcessedMessage.message_id).filter(
+                ProcessedMessage.message_id.in_(unknown)
+            ).all()}
+            for message_id in seen:
+                self.recent.set(message_id, True)
+            unknown -= seen
+        return unknown
+
+    def mark(self, db: Session, message_ids: Iterable[str]):
+        """Record the ids in the caller's transaction"""
+        message_ids = list(message_ids)
+        db.add_all([ProcessedMessage(message_id=message_id) for message_id in message_ids])
+        self._since_prune += len(message_ids)
+        if self._since_prune >= DEDUPE_PRUNE_EVERY:
+            self._since_prune = 0
+            db.query(ProcessedMessage).filter(
+                ProcessedMessage.created_at < datetime.now() - timedelta(days=DEDUPE_RETENTION_DAYS)
+            ).delete(synchronize_session=False)
+
+    def posted_ids(self, db: Session, message_ids: Iterable[str]) -> Set[str]:
+        """Return the ids an earlier attempt already posted to the OpenAI thread"""
+        return {message_id for (message_id,) in db.query(ProcessedMessage.message_id).filter(
+            ProcessedMessage.message_id.in_(list(message_ids)),
+            ProcessedMessage.posted_at.isnot(None)
+        ).all()}
+
+    def mark_posted(self, db: Session, message_ids: Iterable[str]):
+        """Record in the caller's transaction that the messages reached the thread"""
+        db.query(ProcessedMessage).filter(
+            ProcessedMessage.message_id.in_(list(message_ids))
+        ).update({ProcessedMessage.posted_at: datetime.now()}, synchronize_session=False)
+
+    def recorded_reply(self, db: Session, message_ids: Iterable[str]) -> Optional[str]:
+        """The reply an earlier attempt produced for exactly these messages, if any"""
+        message_ids = set(message_ids)
+        rows = db.query(ProcessedMessage.reply_text).filter(ProcessedMessage.message_id.in_(message_ids)).all()
+        replies = {reply for (reply,) in rows}
+        # A burst that grew since, or was never answered, needs a fresh run
+        if len(rows) != len(message_ids) or len(replies) != 1 or None in replies:
+            return None
+        return replies.pop()
+
+    def record_reply(self, db: Session, message_ids: Iterable[str], reply: str):
+        """Keep the reply to the messages in the caller's transaction, before it is stored and queued"""
+        db.query(ProcessedMessage).filter(
+            ProcessedMessage.message_id.in_(list(message_ids))
+        ).update({ProcessedMessage.reply_text: reply}, synchronize_session=False)
+
+    def remember(self, message_ids: Iterable[str]):
+        """Cache ids once the transaction that marked them has committed"""
+        for message_id in message_ids:
+            self.recent.set(message_id, True)
+
+
+message_dedupe = MessageDedupe(
+    maxsize=int(os.getenv("DEDUPE_CACHE_SIZE", 50000)),
+    ttl=float(os.getenv("DEDUPE_CACHE_TTL", 3600))
+)
+metrics.register_collector("message_dedupe", message_dedupe.recent.stats)
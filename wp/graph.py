@@ -0,0 +1,73 @@
+from dotenv import load_dotenv
+from typing import Any, Dict, Optional
+from utils.metrics import track
+import httpx
+import os
+
+load_dotenv()
+
+version = os.getenv("VERSION")
+GRAPH_BASE_URL = f"https://graph.facebook.com/{version}"
+
+# One pooled HTTP/2 connection set to graph.facebook.com for the whole process
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", 20))
+GRAPH_MAX_KEEPALIVE = int(os.getenv("GRAPH_MAX_KEEPALIVE", 10))
+GRAPH_KEEPALIVE_EXPIRY = float(os.getenv("GRAPH_KEEPALIVE_EXPIRY", 60))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", 5))
+GRAPH_TIMEOUT = float(os.getenv("GRAPH_TIMEOUT", 15))
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def start_graph_client() -> httpx.AsyncClient:
+    """Open the shared Graph API client; called from the app lifespan, or lazily on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=GRAPH_BASE_URL,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=GRAPH_MAX_CONNECTIONS,
+                max_keepalive_connections=GRAPH_MAX_KEEPALIVE,
+                keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(GRAPH_TIMEOUT, connect=GRAPH_CONNECT_TIMEOUT)
+        )
+    return _client
+
+
+async def close_graph_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def graph_client() -> httpx.AsyncClient:
+    return start_graph_client()
+
+
+async def post_graph(path: str, token: str, data: Dict[str, Any], operation: str = "messages", org_id: int = None) -> httpx.Response:
+    """POST a JSON body to a Graph API path (e.g. "<phone_number_id>/messages")"""
+    async with track(operation, org_id, metric="graph_latency_ms"):
+        return await graph_client().post(
+            f"/{path}",
+            headers={"Authorization": f"Bearer {token}"},
+            json=data
+        )
+
+
+async def upload_media(phone_number_id: str, token: str, media_url: str, org_id: int = None) -> str:
+    """Fetch a file and upload it to Meta once; returns the media id to reference in messages"""
+    async with track("media_upload", org_id, metric="graph_latency_ms"):
+        source = await graph_client().get(media_url)
+        source.raise_for_status()
+        mime_type = source.headers.get("content-type", "application/octet-stream").split(";")[0]
+        response = await graph_client().post(
+            f"/{phone_number_id}/media",
+            headers={"Authorization": f"Bearer {token}"},
+            data={"messaging_product": "whatsapp", "type": mime_type},
+            files={"file": (media_url.rsplit("/", 1)[-1] or "media", source.content, mime_type)}
+        )
+        response.raise_for_status()
+    return response.json()["id"]
@@ -0,0 +1,305 @@
+from sqlalchemy import or_, and_, func, exists
+from sqlalchemy.orm import Session, aliased
+from db.models import SessionLocal, OutboundMessage
+from ai.governor import TokenBucket
+from wp.graph import post_graph
+from wp.send_msg_imgs import text_message
+from wp.tenants import tenant_registry
+from utils.metrics import metrics
+from utils.log import get_logger
+from datetime import datetime, timedelta
+from collections import Counter
+from typing import Any, Dict, Optional
+import asyncio
+import random
+import httpx
+import json
+import os
+
+logger = get_logger(__name__)
+
+# Graph API error codes worth retrying: throttling and temporary outages
+RETRYABLE_ERROR_CODES = {1, 2, 4, 80007, 130429, 131000, 131016, 131056}
+
+
+class Outbox:
+    """
+    Persistent queue of outbound WhatsApp messages in the `outbound_messages` table.
+
+    A dispatcher claims due messages in batches and sends them through the
+    shared Graph client, paced per sending `phone_number_id` with a token
+    bucket. Messages to one recipient go out in the order they were queued;
+    otherwise lower `priority` goes first, so replies overtake broadcasts.
+    429s, 5xx, transport errors and Meta's throttling codes are retried with
+    jittered exponential backoff; other errors fail the message. The Meta
+    message id and the final status are stored on the row.
+    """
+
+    def __init__(self, messages_per_second: float = 20, batch_size: int = 50, max_attempts: int = 6, visibility_timeout: float = 120, poll_interval: float = 1.0):
+        self.messages_per_second = messages_per_second
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.counters = Counter()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._task = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    def enqueue(
+        self,
+        db: Session,
+        organization_id: int,
+        to_phone: str,
+        payload: Dict[str, Any],
+        contact_id: int = None,
+        prompt_id: int = None,
+        phone_number_id: str = None,
+        campaign_id: int = None,
+        priority: int = 0
+    ) -> OutboundMessage:
+        """Add a message to the caller's transaction; it is sent once the caller commits"""
+        message = OutboundMessage(
+            organization_id=organization_id,
+            contact_id=contact_id,
+            prompt_id=prompt_id,
+            campaign_id=campaign_id,
+            priority=priority,
+            phone_number_id=phone_number_id or tenant_registry.for_org(organization_id).phone_number_id,
+            to_phone=to_phone,
+            payload=json.dumps(payload),
+            status="queued",
+            attempts=0,
+            available_at=datetime.now()
+        )
+        db.add(message)
+        self.counters["enqueued"] += 1
+        return message
+
+    def enqueue_text(self, db: Session, organization_id: int, to_phone: str, body: str, **options) -> OutboundMessage:
+        return self.enqueue(db, organization_id, to_phone, text_message(to_phone, body), **options)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _bucket(self, phone_number_id: str) -> TokenBucket:
+        if phone_number_id not in self._buckets:
+            # Bursts are capped at one second of sends, not the minute the bucket refills over
+            self._buckets[phone_number_id] = TokenBucket(self.messages_per_second * 60, capacity=max(1, self.messages_per_second))
+        return self._buckets[phone_number_id]
+
+    async def pace(self, phone_number_id: str):
+        """Wait for a send slot of the business number"""
+        bucket = self._bucket(phone_number_id)
+        wait = bucket.wait_time(1)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = bucket.wait_time(1)
+        bucket.take(1)
+
+    @staticmethod
+    def _claimable(now: datetime):
+        earlier = aliased(OutboundMessage)
+        # An older unsent message to the same recipient holds the later ones back
+        blocked = exists().where(
+            earlier.phone_number_id == OutboundMessage.phone_number_id,
+            earlier.to_phone == OutboundMessage.to_phone,
+            earlier.id < OutboundMessage.id,
+            earlier.status.in_(("queued", "sending"))
+        )
+        return and_(
+            or_(
+                and_(OutboundMessage.status == "queued", OutboundMessage.available_at <= now),
+                and_(OutboundMessage.status == "sending", OutboundMessage.locked_until < now)
+            ),
+            ~blocked
+        )
+
+    def _claim(self) -> list:
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            locked_until = now + timedelta(seconds=self.visibility_timeout)
+            candidates = [message_id for (message_id,) in db.query(OutboundMessage.id).filter(
+                self._claimable(now)
+            ).order_by(OutboundMessage.priority, OutboundMessage.id).limit(self.batch_size).all()]
+            if not candidates:
+                return []
+            db.query(OutboundMessage).filter(OutboundMessage.id.in_(candidates), self._claimable(now)).update({
+                OutboundMessage.status: "sending",
+                OutboundMessage.locked_until: locked_until,
+                OutboundMessage.attempts: OutboundMessage.attempts + 1
+            }, synchronize_session=False)
+            db.commit()
+            claimed = db.query(OutboundMessage).filter(
+                OutboundMessage.id.in_(candidates),
+                OutboundMessage.status == "sending",
+                OutboundMessage.locked_until == locked_until
+            ).order_by(OutboundMessage.id).all()
+            return [
+                {
+                    "id": message.id,
+                    "organization_id": message.organization_id,
+                    "phone_number_id": message.phone_number_id,
+                    "to_phone": message.to_phone,
+                    "payload": json.loads(message.payload),
+                    "attempts": message.attempts
+                }
+                for message in claimed
+            ]
+        finally:
+            db.close()
+
+    def _record(self, message_id: int, values: dict):
+        db = SessionLocal()
+        try:
+            db.query(OutboundMessage).filter(OutboundMessage.id == message_id).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    @staticmethod
+    def _is_retryable(response: httpx.Response) -> bool:
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        try:
+            code = response.json().get("error", {}).get("code")
+        except ValueError:
+            return False
+        return code in RETRYABLE_ERROR_CODES
+
+    def _retry_values(self, message: dict, error: str, retry_after: float = 0) -> dict:
+        values = {OutboundMessage.last_error: error[:2000], OutboundMessage.locked_until: None}
+        if message["attempts"] >= self.max_attempts:
+            values.update({OutboundMessage.status: "failed"})
+            self.counters["failed"] += 1
+            metrics.inc("outbox_failed", 1, message["organization_id"])
+        else:
+            delay = max(retry_after, min(300, 2 ** message["attempts"]) * random.uniform(0.5, 1.5))
+            values.update({OutboundMessage.status: "queued", OutboundMessage.available_at: datetime.now() + timedelta(seconds=delay)})
+            self.counters["retried"] += 1
+        return values
+
+    async def _send(self, message: dict):
+        await self.pace(message["phone_number_id"])
+        try:
+            response = await post_graph(
+                f"{message['phone_number_id']}/messages",
+                tenant_registry.token_for(message["phone_number_id"]),
+                message["payload"],
+                operation="outbox_send",
+                org_id=message["organization_id"]
+            )
+        except httpx.HTTPError as e:
+            values = self._retry_values(message, f"{type(e).__name__}: {str(e)}")
+        else:
+            if response.is_success:
+                try:
+                    wa_message_id = (response.json().get("messages") or [{}])[0].get("id")
+                except (ValueError, AttributeError, IndexError):
+                    # Meta accepted the message, so it must not be sent again; only its statuses cannot be matched
+                    logger.warning("Unexpected send response", extra={"message_id": message["id"], "body": response.text[:500]})
+                    wa_message_id = None
+                values = {
+                    OutboundMessage.status: "sent",
+                    OutboundMessage.wa_message_id: wa_message_id,
+                    OutboundMessage.sent_at: datetime.now(),
+                    OutboundMessage.locked_until: None,
+                    OutboundMessage.last_error: None
+                }
+                self.counters["sent"] += 1
+            elif self._is_retryable(response):
+                if response.status_code == 429:
+                    # Meta is throttling the number: empty its bucket so its other sends slow down too
+                    bucket = self._bucket(message["phone_number_id"])
+                    bucket.adjust(bucket.capacity)
+                    self.counters["throttled"] += 1
+                retry_after = response.headers.get("retry-after", "")
+                retry_after = float(retry_after) if retry_after.isdigit() else 0
+                values = self._retry_values(message, f"{response.status_code}: {response.text}", retry_after)
+            else:
+                values = {
+                    OutboundMessage.status: "failed",
+                    OutboundMessage.last_error: f"{response.status_code}: {response.text}"[:2000],
+                    OutboundMessage.locked_until: None
+                }
+                self.counters["failed"] += 1
+                metrics.inc("outbox_failed", 1, message["organization_id"])
+        try:
+            await asyncio.to_thread(self._record, message["id"], values)
+        except Exception as e:
+            # The row stays claimed and is picked up again after its visibility timeout
+            logger.error("Could not record outbound message", extra={"message_id": message["id"], "error": str(e)})
+            self.counters["record_errors"] += 1
+
+    async def _dispatcher(self):
+        while self._running:
+            try:
+                batch = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                # E.g. "database is locked" under write load; the next poll tries again
+                logger.error("Could not claim outbound messages", extra={"error": str(e)})
+                self.counters["claim_errors"] += 1
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if not batch:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # At most one message per recipient is claimed at a time, so sends can all run together
+            results = await asyncio.gather(*(self._send(message) for message in batch), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Outbox dispatch error", extra={"error": str(result)})
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatcher())
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Finish the batch being sent; unsent claims are picked up again after their visibility timeout"""
+        self._running = False
+        self.wake()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        db = SessionLocal()
+        try:
+            depth = dict(db.query(OutboundMessage.status, func.count(OutboundMessage.id)).group_by(OutboundMessage.status).all())
+            oldest = db.query(func.min(OutboundMessage.created_at)).filter(OutboundMessage.status == "queued").scalar()
+        finally:
+            db.close()
+        return {
+            "depth": depth,
+            "oldest_queued_seconds": round((datetime.now() - oldest).total_seconds(), 1) if oldest else 0,
+            "counters": dict(self.counters)
+        }
+
+
+outbox = Outbox(
+    messages_per_second=float(os.getenv("OUTBOX_MESSAGES_PER_SECOND", 20)),
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", 50)),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6)),
+    visibility_timeout=float(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", 120)),
+    poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL", 1.0))
+)
+
+
+async def _collect_outbox_stats():
+    return await asyncio.to_thread(outbox.stats)
+
+metrics.register_collector("outbox", _collect_outbox_stats)
@@ -1,59 +1,50 @@
-import json
 from dotenv import load_dotenv
-import os
-import requests
- 
+from wp.graph import post_graph
+from wp.tenants import tenant_registry
+from utils.log import get_logger
+
 load_dotenv()
- 
-token = os.getenv("ACCESS_TOKEN")
-version = os.getenv("VERSION")
-number_id = os.getenv("PHONE_NUMBER_ID")
- 
- 
-def send_txt_msg(phone_num: str, output: str):
-    url = f"https://graph.facebook.com/{version}/{number_id}/messages"
-
-    headers = {
-        "Authorization" : f"Bearer {token}",
-        "Content-type": "application/json"
-    }
 
-    data = {
+logger = get_logger(__name__)
+
+
+def text_message(phone_num: str, output: str) -> dict:
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": phone_num,
         "type": "text",
-    
+
         "text": {
-            "body": output # use body to send msgs 
+            "body": output # use body to send msgs
         }
     }
-    
-    response = requests.post(url=url, headers=headers, json=data)
-    print(response.json())
-    return response
- 
- 
-def send_img(user_contact_number: str): #JPG.JPEG,PNG
-    url = f"https://graph.facebook.com/{version}/{number_id}/messages"
- 
-    headers = {
-        "Authorization" : f"Bearer {token}",
-        "Content-type": "application/json"
-    }
- 
-    data = {
+
+
+def image_message(user_contact_number: str, media_id: str = None, link: str = "https://i.imgur.com/N7Mlq38.jpeg", caption: str = "Testing images") -> dict: #JPG.JPEG,PNG
+    # An uploaded media id is reused as is; a link makes Meta fetch the file for every message
+    image = {"id": media_id} if media_id else {"link": link}
+    if caption:
+        image["caption"] = caption
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": user_contact_number,
         "type": "image",
- 
-        "image": {
-            "link": "https://i.imgur.com/N7Mlq38.jpeg", # use links of images to send ###
-            "caption": "Testing images"  ###
-        }
+
+        "image": image
     }
- 
-    response = requests.post(url=url, headers=headers, json=data)
+
+
+async def send_txt_msg(phone_num: str, output: str, org_id: int = None):
+    """Send right away from the org's number; replies to prospects go through wp.outbox instead"""
+    tenant = tenant_registry.for_org(org_id)
+    response = await post_graph(f"{tenant.phone_number_id}/messages", tenant.token, text_message(phone_num, output), operation="send_text", org_id=org_id)
+    logger.debug("Sent text message", extra={"status_code": response.status_code})
+    return response
+
+
+async def send_img(user_contact_number: str, org_id: int = None):
+    tenant = tenant_registry.for_org(org_id)
+    response = await post_graph(f"{tenant.phone_number_id}/messages", tenant.token, image_message(user_contact_number), operation="send_image", org_id=org_id)
     return response
- 
\ No newline at end of file
@@ -0,0 +1,175 @@
+from sqlalchemy import select
+from db.models import SessionLocal, OutboundMessage, Prompt
+from utils.metrics import metrics
+from utils.log import get_logger
+from datetime import datetime
+from collections import Counter
+from typing import Dict, Optional
+import asyncio
+import os
+
+logger = get_logger(__name__)
+
+# Order of the delivery statuses Meta reports; a status never moves a message backwards
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+# Outbound statuses each reported status may replace
+REPLACEABLE = {
+    "delivered": ("sent",),
+    "read": ("sent", "delivered"),
+    "failed": ("sent", "delivered")
+}
+# SQLite caps the number of bound parameters per statement
+UPDATE_CHUNK = 500
+
+
+class StatusIngestor:
+    """
+    Buffers the `statuses` of webhook deliveries and applies them in bulk.
+
+    Every `flush_interval` seconds (or once `batch_size` events are buffered)
+    the events are collapsed to the furthest status per WhatsApp message id and
+    written with one set-based UPDATE per status and event time (Meta reports
+    whole seconds, so a burst shares a few): on `outbound_messages`, and
+    on the prompts whose replies were read (`Prompt.is_seen`). Events for
+    messages whose id is not stored yet (the send is still being recorded) are
+    kept for a few more flushes before they are dropped.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, batch_size: int = 5000, max_deferrals: int = 3):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_deferrals = max_deferrals
+        self.counters = Counter()
+        self._pending: Dict[str, dict] = {}
+        self._task = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    def add(self, statuses: list):
+        for status in statuses:
+            message_id, name = status.get("id"), status.get("status")
+            if not message_id or name not in STATUS_RANK:
+                continue
+            current = self._pending.get(message_id)
+            if current is None or STATUS_RANK[name] > STATUS_RANK[current["status"]]:
+                self._pending[message_id] = {
+                    "status": name,
+                    "timestamp": status.get("timestamp"),
+                    "deferrals": current["deferrals"] if current else 0
+                }
+        self.counters["received"] += len(statuses)
+        if len(self._pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    @staticmethod
+    def _event_time(event: dict, default: datetime) -> datetime:
+        try:
+            return datetime.fromtimestamp(int(event["timestamp"]))
+        except (TypeError, ValueError):
+            return default
+
+    def _apply(self, events: Dict[str, dict]) -> Dict[str, dict]:
+        """Write a batch of events; returns the ones whose message is not stored yet"""
+        db = SessionLocal()
+        try:
+            known = set()
+            ids = list(events)
+            for start in range(0, len(ids), UPDATE_CHUNK):
+                known.update(wa_id for (wa_id,) in db.query(OutboundMessage.wa_message_id).filter(
+                    OutboundMessage.wa_message_id.in_(ids[start:start + UPDATE_CHUNK])
+                ).all())
+
+            # Delivery and read times are reported per message; rows sharing a status and a time update together
+            by_status = {}
+            received_at = datetime.now()
+            for wa_id in known:
+                name = events[wa_id]["status"]
+                at = self._event_time(events[wa_id], received_at) if name in ("delivered", "read") else None
+                by_status.setdefault((name, at), []).append(wa_id)
+
+            for (name, at), wa_ids in by_status.items():
+                for start in range(0, len(wa_ids), UPDATE_CHUNK):
+                    chunk = wa_ids[start:start + UPDATE_CHUNK]
+                    values = {OutboundMessage.status: name}
+                    if at is not None:
+                        values[getattr(OutboundMessage, f"{name}_at")] = at
+                    updated = db.query(OutboundMessage).filter(
+                        OutboundMessage.wa_message_id.in_(chunk),
+                        OutboundMessage.status.in_(REPLACEABLE.get(name, ()))
+                    ).update(values, synchronize_session=False)
+                    self.counters[f"applied_{name}"] += updated
+
+                    if name == "read":
+                        seen = db.query(Prompt).filter(
+                            Prompt.id.in_(select(OutboundMessage.prompt_id).where(OutboundMessage.wa_message_id.in_(chunk))),
+                            Prompt.is_seen.isnot(True)
+                        ).update({Prompt.is_seen: True}, synchronize_session=False)
+                        self.counters["prompts_seen"] += seen
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        deferred = {}
+        for wa_id, event in events.items():
+            if wa_id in known:
+                continue
+            if event["deferrals"] < self.max_deferrals:
+                deferred[wa_id] = {**event, "deferrals": event["deferrals"] + 1}
+            else:
+                self.counters["unmatched"] += 1
+        return deferred
+
+    async def flush(self):
+        if not self._pending:
+            return
+        events, self._pending = self._pending, {}
+        try:
+            deferred = await asyncio.to_thread(self._apply, events)
+        except Exception as e:
+            logger.error("Could not apply message statuses", extra={"events": len(events), "error": str(e)})
+            self.counters["dropped"] += len(events)
+            return
+        metrics.observe("status_batch_size", len(events))
+        for wa_id, event in deferred.items():
+            # A newer status may have arrived while this batch was written
+            if wa_id not in self._pending:
+                self._pending[wa_id] = event
+
+    async def _flusher(self):
+        while self._running:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        """Stop the flusher and write what is still buffered"""
+        self._running = False
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "counters": dict(self.counters)}
+
+
+status_ingestor = StatusIngestor(
+    flush_interval=float(os.getenv("STATUS_FLUSH_INTERVAL", 1.0)),
+    batch_size=int(os.getenv("STATUS_BATCH_SIZE", 5000)),
+    max_deferrals=int(os.getenv("STATUS_MAX_DEFERRALS", 3))
+)
+metrics.register_collector("status_ingestion", status_ingestor.stats)
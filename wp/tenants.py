@@ -0,0 +1,119 @@
+from db.models import SessionLocal, OrganizationKeys
+from utils.metrics import metrics
+from utils.log import get_logger
+from typing import Dict, Optional
+from dotenv import load_dotenv
+import asyncio
+import threading
+import time
+import os
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# Other processes pick up key changes after at most this many seconds
+TENANT_REFRESH_INTERVAL = float(os.getenv("TENANT_REFRESH_INTERVAL", 300))
+
+
+class Tenant:
+    def __init__(self, org_id: Optional[int], phone_number_id: str, token: str):
+        self.org_id = org_id
+        self.phone_number_id = phone_number_id
+        self.token = token
+
+
+class TenantRegistry:
+    """
+    In-memory map of WhatsApp business numbers to organizations and their tokens,
+    built from `organization_keys`. Reloaded when keys change and every
+    TENANT_REFRESH_INTERVAL seconds by a background task, off the event loop,
+    so lookups never wait on the database. Organizations without their own
+    keys send from the PHONE_NUMBER_ID / ACCESS_TOKEN of the environment.
+    """
+
+    def __init__(self, refresh_interval: float = 300):
+        self.refresh_interval = refresh_interval
+        self.default = Tenant(None, os.getenv("PHONE_NUMBER_ID"), os.getenv("ACCESS_TOKEN"))
+        self._by_number: Dict[str, Tenant] = {}
+        self._by_org: Dict[int, Tenant] = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def refresh(self):
+        db = SessionLocal()
+        try:
+            rows = db.query(
+                OrganizationKeys.organization_id,
+                OrganizationKeys.phone_number_id,
+                OrganizationKeys.whatsapp_business_token
+            ).filter(
+                OrganizationKeys.phone_number_id.isnot(None),
+                OrganizationKeys.whatsapp_business_token.isnot(None)
+            ).all()
+        finally:
+            db.close()
+        tenants = [Tenant(org_id, phone_number_id, token) for org_id, phone_number_id, token in rows]
+        with self._lock:
+            self._by_number = {tenant.phone_number_id: tenant for tenant in tenants}
+            self._by_org = {tenant.org_id: tenant for tenant in tenants}
+            self._loaded_at = time.monotonic()
+        logger.info("Tenant registry loaded", extra={"tenants": len(tenants)})
+
+    async def refresh_async(self):
+        await asyncio.to_thread(self.refresh)
+
+    async def _refresher(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh_async()
+            except Exception as e:
+                # Keep routing with the previous map rather than failing messages
+                logger.error("Could not refresh tenant registry", extra={"error": str(e)})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresher())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _ensure_fresh(self):
+        # Inside the app the background task keeps the map current; scripts without it load on demand
+        if self._task is not None:
+            return
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Could not refresh tenant registry", extra={"error": str(e)})
+                self._loaded_at = time.monotonic()
+
+    def by_number(self, phone_number_id: Optional[str]) -> Optional[Tenant]:
+        """Tenant receiving on a business number; None if the number is not registered"""
+        self._ensure_fresh()
+        return self._by_number.get(phone_number_id)
+
+    def for_org(self, org_id: Optional[int]) -> Tenant:
+        """Tenant an organization sends from, falling back to the environment's number"""
+        self._ensure_fresh()
+        return self._by_org.get(org_id, self.default)
+
+    def token_for(self, phone_number_id: Optional[str]) -> str:
+        tenant = self.by_number(phone_number_id)
+        return tenant.token if tenant else self.default.token
+
+    def stats(self) -> dict:
+        return {
+            "tenants": len(self._by_number),
+            "loaded_seconds_ago": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None
+        }
+
+
+tenant_registry = TenantRegistry(refresh_interval=TENANT_REFRESH_INTERVAL)
+metrics.register_collector("tenants", tenant_registry.stats)
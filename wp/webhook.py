@@ -2,85 +2,184 @@ from fastapi import APIRouter, Request, HTTPException, Depends
 from fastapi.responses import PlainTextResponse
 import os
 from dotenv import load_dotenv
-import httpx
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from ai.app import chat_with_assistant
-from schemas.contacts_schema import PrompCreatetModel
-from db.models import get_db, Contact, Organization, Prompt  # Import your models
-from .send_msg_imgs import send_txt_msg
+from ai.app import run_chat_pipeline
+from db.models import get_db, SessionLocal, Contact, Organization  # Import your models
+from utils.jobs import job_queue
+from wp.graph import post_graph
+from wp.dedupe import message_dedupe
+from wp.statuses import status_ingestor
+from wp.contact_cache import resolve_senders
+from wp.tenants import tenant_registry
+from utils.metrics import metrics
+from utils.log import get_logger
+import orjson
 load_dotenv()
 
+logger = get_logger(__name__)
+
 router = APIRouter(
     prefix=""
 )
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
-ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-version = os.getenv("VERSION")
 PORT = int(os.getenv("PORT", 8000))  # Default to 8000 if PORT is not set
+# Messages from one contact arriving within this window are answered by a single run
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", 1500))
+
+def parse_webhook(body: dict):
+    """
+    Flatten every entry and change of a webhook delivery into (messages, statuses),
+    keeping only the fields the pipeline uses
+    """
+    messages, statuses = [], []
+    for entry in body.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            phone_number_id = (value.get("metadata") or {}).get("phone_number_id")
+            for message in value.get("messages") or []:
+                messages.append({
+                    "id": message.get("id"),
+                    "from": message.get("from"),
+                    "type": message.get("type"),
+                    "text": (message.get("text") or {}).get("body"),
+                    "phone_number_id": phone_number_id
+                })
+            for status in value.get("statuses") or []:
+                statuses.append({
+                    "id": status.get("id"),
+                    "status": status.get("status"),
+                    "recipient_id": status.get("recipient_id"),
+                    "timestamp": status.get("timestamp"),
+                    "phone_number_id": phone_number_id
+                })
+    return messages, statuses
+
+
+def queue_text_messages(db: Session, text_messages: list, attempts: int = 2):
+    """Queue the messages not seen before, marking their ids in the same transaction"""
+    # Re-deliveries (and repeats within one delivery) are acknowledged without a reply
+    by_id = {message["id"]: message for message in text_messages}
+    fresh = message_dedupe.new_ids(db, by_id)
+    metrics.inc("webhook_duplicate_messages", len(text_messages) - len(fresh))
+    if not fresh:
+        return
+
+    # The business number a message arrived on decides the org; unregistered numbers
+    # (single-tenant setups using the environment's number) match senders across orgs.
+    # Senders are resolved from the contact cache, or one indexed query per org.
+    senders_by_org = {}
+    for message_id in fresh:
+        message = by_id[message_id]
+        tenant = tenant_registry.by_number(message["phone_number_id"])
+        senders_by_org.setdefault(tenant.org_id if tenant else None, set()).add(message["from"])
+    contacts = {
+        (org_id, phone): contact
+        for org_id, senders in senders_by_org.items()
+        for phone, contact in resolve_senders(db, senders, org_id=org_id).items()
+    }
+
+    # Hand the messages to the job workers and acknowledge Meta right away.
+    # Jobs are grouped per contact: a contact's messages are coalesced into one run,
+    # while different contacts are answered in parallel by the worker pool.
+    jobs = []
+    for message_id, message in by_id.items():
+        tenant = tenant_registry.by_number(message["phone_number_id"])
+        contact = contacts.get((tenant.org_id if tenant else None, message["from"]))
+        if message_id not in fresh or not contact:
+            continue
+        jobs.append(({
+            "contact_id": contact["contact_id"],
+            "org_id": contact["org_id"],
+            "input_text": str(message["text"]),  #USER-INPUT/REPLY
+            "message_id": message_id,
+            "phone_number_id": message["phone_number_id"]
+        }, f"contact:{contact['contact_id']}"))
+    metrics.observe("webhook_batch_size", len({group_key for _, group_key in jobs}), operation="contacts")
+    metrics.inc("webhook_unknown_senders", len(fresh) - len(jobs))
+
+    queued_ids = [payload["message_id"] for payload, _ in jobs]
+    try:
+        message_dedupe.mark(db, queued_ids)
+        job_queue.enqueue_many("inbound_message", jobs, db, delay=COALESCE_WINDOW_MS / 1000)
+    except IntegrityError:
+        # A concurrent re-delivery marked some of the ids first; retry with what is left
+        db.rollback()
+        if attempts > 1:
+            queue_text_messages(db, text_messages, attempts - 1)
+        return
+    message_dedupe.remember(queued_ids)
+
 
 @router.post("/webhook")
 async def webhook(request: Request, db: Session = Depends(get_db)):
-    body = await request.json()
-    print("Incoming webhook message:", body)
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        # Meta would keep re-delivering a payload we reject, so acknowledge it anyway
+        logger.warning("Ignoring webhook with an invalid JSON body")
+        return PlainTextResponse('', status_code=200)
 
-    message = body.get("entry", [{}])[0].get("changes", [{}])[0].get("value", {}).get("messages", [{}])[0]
+    messages, statuses = parse_webhook(body)
+    logger.debug("Incoming webhook", extra={"messages": len(messages), "statuses": len(statuses)})
+    text_messages = [message for message in messages if message.get("type") == "text"]
+    metrics.observe("webhook_batch_size", len(messages), operation="messages")
+    metrics.observe("webhook_batch_size", len(statuses), operation="statuses")
+    metrics.inc("webhook_messages", len(messages))
+    metrics.inc("webhook_statuses", len(statuses))
+    metrics.inc("webhook_unsupported_messages", len(messages) - len(text_messages))
 
-    if message.get("type") == "text":
-        business_phone_number_id = body.get("entry", [{}])[0].get("changes", [{}])[0].get("value", {}).get("metadata", {}).get("phone_number_id")
-        message_text = str(message["text"]["body"])  #USER-INPUT/REPLY
-        sender_phone = message["from"]
+    # Delivery and read statuses are applied in bulk by the status ingestor
+    status_ingestor.add(statuses)
 
+    if text_messages:
         try:
-            # Look up contact by phone number
-            contact = db.query(Contact).filter(Contact.phone_number == sender_phone).first()
-            if not contact:
-                return PlainTextResponse('', status_code=200)
-
-            # Create prompt model
-            prompt = PrompCreatetModel(
-                input_text=message_text
-            )
-
-            # Call chat_with_assistant with correct IDs
-            assistant_response = await chat_with_assistant(
-                user_input=prompt,
-                contact_id=contact.id,
-                org_id=contact.org_id,
-                db=db
-            )
-            print(assistant_response) 
+            queue_text_messages(db, text_messages)
         except Exception as e:
-            print(f"Error processing message: {str(e)}")
-            return PlainTextResponse('', status_code=200)
-
-        #send_txt_msg(sender_phone, assistant_response)
-            # Mark incoming message as read
-        read_data = {
-                "messaging_product": "whatsapp",
-                "status": "read",
-                "message_id": message["id"],
-            }
-        print(read_data)
-        if read_data["status"] == "read":
-            prompt_instance= db.query(Prompt).filter(Prompt.contact_id == contact.id).first()
-            print('fnnn-011')
-            if prompt_instance.is_seen != True:
-                print('fnnnn-02')
-                prompt_instance.is_seen= True
-                db.add(prompt_instance)
-                db.commit()
-                db.refresh(prompt_instance)
-
-        async with httpx.AsyncClient() as client:
-                await client.post(
-                    f"https://graph.facebook.com/{version}/{business_phone_number_id}/messages", 
-                    headers={"Authorization": f"Bearer {ACCESS_TOKEN}"},
-                    json=read_data
-                )
+            db.rollback()
+            logger.error("Error queueing messages", extra={"error": str(e), "messages": len(text_messages)})
     return PlainTextResponse('', status_code=200)
 
 
+@job_queue.handler("inbound_message", coalesce=True)
+async def process_inbound_messages(payloads: list):
+    """Answer a burst of queued messages from one contact with a single run and mark them read"""
+    # The latest message carries the read receipt; WhatsApp marks earlier ones read with it
+    payload = payloads[-1]
+    db = SessionLocal()
+    try:
+        row = db.query(Contact, Organization).join(Organization, Organization.id == Contact.org_id).filter(
+            Contact.id == payload["contact_id"]
+        ).first()
+        contact, organization = row if row else (None, None)
+        if not contact:
+            logger.warning("Dropping message: contact or organization no longer exists", extra={"message_id": payload["message_id"]})
+            return
+
+        input_text = "\n".join(p["input_text"] for p in payloads)
+        # A retried job must not post the messages an earlier attempt already put on the thread
+        posts = {p["message_id"]: p["input_text"] for p in payloads}
+        await run_chat_pipeline(db, contact, organization, input_text, posts=posts)
+
+        # Mark incoming message as read; the reply is already queued, so never retry from here.
+        # Prompt.is_seen follows the read status of the reply, see wp.statuses
+        try:
+            read_data = {
+                    "messaging_product": "whatsapp",
+                    "status": "read",
+                    "message_id": payload["message_id"],
+                }
+            await post_graph(f"{payload['phone_number_id']}/messages", tenant_registry.token_for(payload["phone_number_id"]), read_data, operation="mark_read", org_id=organization.id)
+        except Exception as e:
+            logger.warning("Error marking message as read", extra={"message_id": payload["message_id"], "error": str(e)})
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 
 @router.get("/webhook")
 async def verify_webhook(request: Request):
@@ -92,7 +191,7 @@ async def verify_webhook(request: Request):
 
     # Check the mode and token sent are correct
     if mode == "subscribe" and token == VERIFY_TOKEN:
-        print("Webhook verified successfully!")
+        logger.info("Webhook verified successfully")
         return PlainTextResponse(challenge)
     else:
         raise HTTPException(status_code=403, detail="Verification token mismatch.")